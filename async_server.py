@@ -0,0 +1,144 @@
+##############################################################################
+# async_server.py
+##############################################################################
+import asyncio
+import functools
+import logging
+import chatlib
+import event_loop
+import server_skeleton
+
+# The asyncio server serves the same protocol with the same handlers as server_skeleton,
+# so storage and timers can be added as coroutines without blocking the loop.
+
+log = logging.getLogger("trivia.async_server")
+framers = {}  # A dictionary of client writers to their chatlib.MessageFramer, for the format of pushed messages
+
+
+def push_message(writer, broadcast):
+    """
+    Writes a message the client didn't ask for, e.g. its room's question. Skipped for a client that doesn't read
+    what it was sent
+    :param writer: the client's stream writer
+    :type writer: asyncio.StreamWriter
+    :param broadcast: the message, encoded once for all of its clients
+    :type broadcast: rooms.Broadcast
+    """
+    if writer.transport.get_write_buffer_size() > server_skeleton.MAX_PENDING_BYTES:
+        return
+    framer = framers.get(writer)
+    writer.write(broadcast.encoded(framer is not None and framer.binary))
+
+
+def socket_gauges():
+    """
+    return: the clients with replies waiting in their transport's buffer, and the bytes waiting
+    :rtype: list
+    """
+    sizes = [writer.transport.get_write_buffer_size() for writer in framers]
+    return [("outbound_sockets", sum(1 for size in sizes if size)), ("outbound_bytes", sum(sizes))]
+
+
+async def handle_connection(state, reader, writer):
+    """
+    Serves one client until it logs out or disconnects
+    :param state: the server's game data
+    :type state: server_skeleton.ServerState
+    :param reader: the client's stream reader
+    :type reader: asyncio.StreamReader
+    :param writer: the client's stream writer, it stands for the client's socket in the logged users registry
+    :type writer: asyncio.StreamWriter
+    """
+    framer = chatlib.MessageFramer()  # Keeps the leftovers of partial messages
+    framers[writer] = framer
+    state.metrics.count("connections_accepted")
+    log.debug("New client joined! %s", writer.get_extra_info("peername"))
+    try:
+        while True:
+            try:
+                msg_code = await asyncio.wait_for(reader.read(server_skeleton.RECV_BUFFER_SIZE),
+                                                  server_skeleton.IDLE_TIMEOUT)
+            except asyncio.TimeoutError:  # Idle for too long
+                state.metrics.count("idle_clients_reaped")
+                return
+            if msg_code == b"":  # The client closed the connection
+                return
+            state.metrics.count("bytes_in", len(msg_code))
+            framer.feed(msg_code)
+            served = 0
+            for cmd, data in framer.messages():  # Serve every pipelined request
+                if cmd is None and data is None:
+                    return
+                served += 1
+                if served % server_skeleton.MESSAGES_PER_TURN == 0:
+                    await asyncio.sleep(0)  # Let the other clients have their turn
+                log.debug("[CLIENT] %s %s", cmd, data)
+                reply = server_skeleton.handle_client_message(state, writer, cmd, data)
+                if cmd == "LOGOUT":
+                    return
+                if reply is not None:
+                    encoded = server_skeleton.encode_reply(reply, framer.binary)  # Answered in the client's format
+                    writer.write(encoded)
+                    state.metrics.count("bytes_out", len(encoded))
+                    log.debug("[SERVER] %s", reply)
+            await writer.drain()  # Back-pressure - waits while the client doesn't read its replies
+    except (ConnectionError, OSError):  # Handle in clients which closed cmd without error
+        return
+    finally:
+        username = server_skeleton.handle_logout_message(state, writer)
+        state.forget_client(writer)
+        framers.pop(writer, None)
+        writer.close()
+        state.metrics.count("connections_closed")
+        log.debug("Connection closed. Client %s has logged out.", username)
+
+
+async def run_timers(state):
+    """
+    Advances the answer deadlines and room rounds of the handlers every tick of the timer wheel
+    :param state: the server's game data
+    :type state: server_skeleton.ServerState
+    """
+    while True:
+        timeout = state.timers.next_timeout()
+        await asyncio.sleep(timeout if timeout is not None else event_loop.TIMER_TICK)
+        state.timers.advance()
+
+
+async def serve(state, host, port):
+    """
+    Serves clients on the given address until cancelled
+    :param state: the server's game data
+    :type state: server_skeleton.ServerState
+    :param host: IP to listen on
+    :type host: str
+    :param port: port to listen on
+    :type port: int
+    """
+    server = await asyncio.start_server(functools.partial(handle_connection, state), host, port,
+                                        backlog=server_skeleton.LISTEN_BACKLOG)
+    log.info("Listening for clients on %s:%d", host, port)
+    state.push = push_message
+    state.socket_gauges = socket_gauges
+    loop = asyncio.get_running_loop()
+    state.offload = lambda job, callback: loop.run_in_executor(None, job).add_done_callback(callback)
+    timers = asyncio.ensure_future(run_timers(state))  # Kept referenced - the loop holds its tasks only weakly
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        timers.cancel()
+
+
+def main():
+    server_skeleton.setup_logging()
+    state = server_skeleton.create_server_state()
+    log.info("Welcome to Trivia Server! (asyncio)")
+    try:
+        asyncio.run(serve(state, server_skeleton.SERVER_IP, server_skeleton.SERVER_PORT))
+    finally:
+        state.score_log.close()  # Writes the score changes still queued, e.g. after Ctrl-C
+
+
+if __name__ == '__main__':
+    main()
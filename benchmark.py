@@ -0,0 +1,308 @@
+##############################################################################
+# benchmark.py
+##############################################################################
+# Usage: python benchmark.py servers [clients] [requests_per_client]
+#        python benchmark.py persistence [users] [log_lines]
+#        python benchmark.py loaders [users] [questions]
+#        python benchmark.py framing [messages]
+#        python benchmark.py questions [questions]
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+import chatlib
+import server_skeleton
+import async_server
+import persistence
+import question_bank
+import user_store
+
+BENCH_IP = "127.0.0.1"
+
+
+# SYNTHETIC DATA
+
+def make_users(count):
+    """
+    Returns users dictionary of user0..user<count-1>, all with the password "pass"
+    """
+    return {"user" + str(i): user_store.UserRecord("pass", i % 1000) for i in range(count)}
+
+
+def make_questions(count):
+    """
+    Returns questions dictionary with count questions, ids from 1
+    """
+    return {i: {"question": "How much is " + str(i) + "+1?", "answers": [str(i), str(i + 1), str(i + 2), str(i + 3)],
+                "correct": "2"} for i in range(1, count + 1)}
+
+
+# SERVER THROUGHPUT
+
+def run_server(mode, port, users_count):
+    """
+    Runs a server without rate limits in this process, its debug prints go to devnull. Used as a multiprocessing target
+    """
+    sys.stdout = open(os.devnull, "w")
+    state = server_skeleton.ServerState(make_users(users_count), make_questions(1000))
+    state.rate_limits = {}  # The benchmark clients send as fast as they can
+    if mode == "select":
+        server_skeleton.SERVER_IP = BENCH_IP
+        server_skeleton.SERVER_PORT = port
+        server_skeleton.serve(state, server_skeleton.setup_socket())
+    else:
+        asyncio.run(async_server.serve(state, BENCH_IP, port))
+
+
+async def bench_client(port, index, requests_count, commands):
+    """
+    Logs in and sends requests_count requests one after another, each waits for its reply
+    Returns: number of replies
+    """
+    reader, writer = await asyncio.open_connection(BENCH_IP, port)
+    framer = chatlib.MessageFramer()
+
+    async def request(cmd, data):
+        writer.write(chatlib.build_message(cmd, data).encode())
+        message = framer.next_message()
+        while message is None:
+            framer.feed(await reader.read(4096))
+            message = framer.next_message()
+        return message
+
+    await request("LOGIN", "user" + str(index) + "#pass")
+    for i in range(requests_count):
+        await request(commands[i % len(commands)], "")
+    writer.close()
+    return requests_count
+
+
+async def bench_clients(port, clients_count, requests_count, commands):
+    results = await asyncio.gather(*[bench_client(port, i, requests_count, commands) for i in range(clients_count)])
+    return sum(results)
+
+
+def free_port():
+    """
+    Returns a port nothing listens on - a fresh one for every run, so TIME_WAIT of the last run doesn't matter
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((BENCH_IP, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((BENCH_IP, port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server didn't start")
+
+
+def bench_servers(clients_count=100, requests_count=200):
+    """
+    Compares the request throughput of the select server and the asyncio server
+    """
+    commands = ["MY_SCORE", "LOGGED", "GET_QUESTION", "HIGHSCORE"]
+    for mode in ("select", "asyncio"):
+        port = free_port()
+        server = multiprocessing.Process(target=run_server, args=(mode, port, clients_count), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            start = time.perf_counter()
+            total = asyncio.run(bench_clients(port, clients_count, requests_count, commands))
+            elapsed = time.perf_counter() - start
+            print("%-8s %6d clients %8d requests %7.2f s %10.0f req/s" % (mode, clients_count, total, elapsed,
+                                                                          total / elapsed))
+        finally:
+            server.terminate()
+            server.join()
+
+
+# SCORE PERSISTENCE
+
+def bench_persistence(users_count=1000000, log_count=1000000):
+    """
+    Times the start of the server's users - loading the snapshot and replaying the score log - and the log's writing
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, "users_snapshot.txt")
+        log_path = os.path.join(directory, "scores.log")
+        users = make_users(users_count)
+        persistence.write_snapshot(snapshot_path, users)
+
+        score_log = persistence.ScoreLog(log_path)
+        start = time.perf_counter()
+        for i in range(log_count):
+            score_log.record("user" + str(i % users_count), i % 1000 + 1, i)
+        queued = time.perf_counter() - start
+        score_log.close()
+        written = time.perf_counter() - start
+        print("record  %8d changes  %7.3f s queued  %7.3f s written" % (log_count, queued, written))
+
+        start = time.perf_counter()
+        users = persistence.load_snapshot(snapshot_path)
+        loaded = time.perf_counter() - start
+        applied = persistence.replay_log(log_path, users)
+        replayed = time.perf_counter() - start
+        print("restore %8d users  %7.3f s snapshot  %7.3f s with %d log lines" % (len(users), loaded, replayed,
+                                                                                   applied))
+
+
+# FILE LOADERS
+
+def legacy_load_users(path):
+    """
+    The users loader before the streaming one: the whole file read at once, a dictionary per user
+    """
+    users = {}
+    with open(path, "r") as users_file:
+        for line in users_file.read().splitlines():
+            fields = line.split(", ")
+            users[fields[0]] = {"password": fields[1], "score": fields[2], "questions_asked": []}
+    return users
+
+
+def legacy_load_questions(path):
+    """
+    The questions loader before the streaming one: a list of answers per question, nothing shared
+    """
+    questions = {}
+    with open(path, "r") as questions_file:
+        lines = questions_file.read().splitlines()
+    for i in range(0, len(lines) - 1, 2):
+        fields = lines[i + 1].split(",")
+        questions[lines[i]] = {"question": fields[0], "answers": [answer.strip() for answer in fields[1:5]],
+                               "correct": fields[5].strip()}
+    return questions
+
+
+def measure_loader(name, loader, path):
+    """
+    Prints the time and the peak memory of one loader. Timed without tracemalloc, which slows every allocation
+    """
+    start = time.perf_counter()
+    result = loader(path)
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = loader(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%-20s %8d records %7.3f s %8.1f MB peak" % (name, len(result), elapsed, peak / 2 ** 20))
+
+
+def bench_loaders(users_count=1000000, questions_count=200000):
+    """
+    Compares the old whole-file dictionary loaders with the streaming ones on generated users and questions files
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        users_path = os.path.join(directory, "users.txt")
+        with open(users_path, "w", encoding="utf-8") as users_file:
+            for i in range(users_count):
+                users_file.write("user" + str(i) + ", pass, " + str(i % 1000) + "\n")
+        questions_path = os.path.join(directory, "questions.txt")
+        with open(questions_path, "w", encoding="utf-8") as questions_file:
+            for question_id, info in make_questions(questions_count).items():
+                questions_file.write(str(question_id) + "\n" + info["question"] + ", " + ", ".join(info["answers"])
+                                     + ", " + info["correct"] + "\n")
+
+        measure_loader("users legacy", legacy_load_users, users_path)
+        measure_loader("users streaming", user_store.load_users_file, users_path)
+        measure_loader("questions legacy", legacy_load_questions, questions_path)
+        measure_loader("questions streaming", question_bank.load_questions_file, questions_path)
+
+
+# QUESTION STORE
+
+def legacy_question_bank(questions):
+    """
+    The bank before the columnar store: the questions dictionary and the encoded message of every question
+    """
+    frames = [chatlib.build_message("YOUR_QUESTION", question_bank.format_question(question_id, info)).encode()
+              for question_id, info in questions.items()]
+    return questions, frames
+
+
+def bench_questions(questions_count=1000000):
+    """
+    Compares the memory of the dictionary bank and the columnar QuestionBank, and the time of answer checks
+    """
+    for name, build in (("dictionaries", lambda: legacy_question_bank(make_questions(questions_count))),
+                        ("columnar", lambda: question_bank.QuestionBank(make_questions(questions_count)))):
+        tracemalloc.start()
+        bank = build()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-12s %8d questions %8.1f MB kept %8.1f MB peak" % (name, questions_count, size / 2 ** 20,
+                                                                   peak / 2 ** 20))
+        del bank
+
+    questions = make_questions(questions_count)
+    bank = question_bank.QuestionBank(questions)
+    ids = list(range(1, questions_count + 1))
+    start = time.perf_counter()
+    correct = sum(1 for question_id in ids if str(questions[question_id]["correct"]) == "2")
+    legacy_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    correct += sum(1 for question_id in ids if bank.is_correct(bank.index_of(question_id), "2"))
+    elapsed = time.perf_counter() - start
+    print("answer checks %9.0f/s dictionaries %9.0f/s columnar (%d correct)" % (
+        len(ids) / legacy_elapsed, len(ids) / elapsed, correct))
+
+
+# MESSAGE FRAMING
+
+def bench_framing(messages_count=200000):
+    """
+    Compares the messages per second of the text and the binary format - building the messages,
+    and framing and parsing them out of one stream
+    """
+    sample = [("SEND_ANSWER", "1234#2"), ("YOUR_QUESTION", "1234#How much is 2+2?#3#4#2#1"),
+              ("ALL_SCORE", "\nmaster: 200\nyossi: 50\ntest: 5"), ("MY_SCORE", "")]
+    messages = [sample[i % len(sample)] for i in range(messages_count)]
+    formats = [("text", lambda cmd, data: chatlib.build_message(cmd, data).encode(), b""),
+               ("binary", chatlib.build_binary_message, chatlib.BINARY_PREAMBLE)]
+    for name, build, preamble in formats:
+        start = time.perf_counter()
+        encoded = [build(cmd, data) for cmd, data in messages]
+        built = time.perf_counter() - start
+
+        stream = preamble + b"".join(encoded)
+        framer = chatlib.MessageFramer()
+        start = time.perf_counter()
+        parsed = 0
+        for i in range(0, len(stream), server_skeleton.RECV_BUFFER_SIZE):  # Fed in recv() sized chunks
+            framer.feed(stream[i:i + server_skeleton.RECV_BUFFER_SIZE])
+            for _ in framer.messages():
+                parsed += 1
+        framed = time.perf_counter() - start
+        print("%-6s %8d messages %9.0f built/s %9.0f parsed/s %9d bytes" % (name, parsed, messages_count / built,
+                                                                            parsed / framed, len(stream)))
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: python benchmark.py " + "|".join(BENCHMARKS) + " [args]")
+        return
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
+
+
+BENCHMARKS = {
+    "servers": bench_servers,
+    "persistence": bench_persistence,
+    "loaders": bench_loaders,
+    "framing": bench_framing,
+    "questions": bench_questions,
+}
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import struct
+
 # Protocol Constants
 
 CMD_FIELD_LENGTH = 16  # Exact length of cmd field (in bytes)
@@ -8,6 +10,13 @@ MAX_MSG_LENGTH = MSG_HEADER_LENGTH + MAX_DATA_LENGTH  # Max size of total messag
 DELIMITER = "|"  # Delimiter character in protocol
 DATA_DELIMITER = "#"  # Delimiter in the data part of the message
 
+# Binary framing: a client that starts the connection with BINARY_PREAMBLE sends and receives binary messages -
+# a command code byte and a 2 bytes data length (network order), then the UTF-8 data.
+# Clients that start with a text message keep the text format.
+BINARY_PREAMBLE = b"\x01"  # Never the first byte of a text message, those start with the command name
+BINARY_HEADER = struct.Struct("!BH")  # Command code, data length
+MAX_BINARY_DATA_LENGTH = 0xFFFF  # Max size of data field of a binary message
+
 # Protocol Messages
 # In this dictionary we will have all the client and server command names
 
@@ -16,17 +25,33 @@ PROTOCOL_CLIENT = {
     "logout_msg": "LOGOUT",
     "my_score_msg": "MY_SCORE",
     "highscore_msg": "HIGHSCORE",
+    "my_rank_msg": "MY_RANK",
     "get_question_msg": "GET_QUESTION",
     "send_answer_msg": "SEND_ANSWER",
-    "logged_msg": "LOGGED"
+    "logged_msg": "LOGGED",
+    "batch_msg": "BATCH",
+    "stats_msg": "STATS",
+    "join_room_msg": "JOIN_ROOM",
+    "leave_room_msg": "LEAVE_ROOM"
 }  # Add more commands if needed
 
 PROTOCOL_SERVER = {
     "login_ok_msg": "LOGIN_OK",
     "login_failed_msg": "ERROR",
+    "throttled_msg": "THROTTLED",  # The request was rate limited, the data is the milliseconds to wait
+    "room_question_msg": "ROOM_QUESTION",  # Pushed to the players of a room, not a reply to a request
+    "round_over_msg": "ROUND_OVER",  # Pushed too, the data is the round's winner ("" if none) and correct answer
 
 }  # ..  Add more commands if needed
 
+# Command codes of the binary messages. New commands are added at the end, so the codes of old ones never change
+COMMANDS = ["LOGIN", "LOGOUT", "MY_SCORE", "HIGHSCORE", "MY_RANK", "GET_QUESTION", "SEND_ANSWER", "LOGGED",
+            "LOGIN_OK", "ERROR", "YOUR_SCORE", "ALL_SCORE", "YOUR_RANK", "LOGGED_ANSWER", "YOUR_QUESTION",
+            "NO_QUESTIONS", "CORRECT_ANSWER", "WRONG_ANSWER", "BATCH", "BATCH_ANSWER",
+            "STATS", "STATS_ANSWER", "THROTTLED", "JOIN_ROOM", "LEAVE_ROOM", "ROOM_JOINED", "ROOM_LEFT",
+            "ROOM_QUESTION", "ROUND_OVER"]
+COMMAND_CODES = {cmd: code for code, cmd in enumerate(COMMANDS, 1)}  # Code 0 is never used
+
 # Other constants
 
 ERROR_RETURN = None  # What is returned in case of an error
@@ -43,20 +68,10 @@ def build_message(cmd, data):
     return: list of fields if all ok. If some error occurred, returns None
     :rtype: str, or None if error occurred
     """
-    full_msg = ""
-    if len(cmd) <= CMD_FIELD_LENGTH and len(data) <= MAX_DATA_LENGTH:  # If cmd and data lengths are allowed:
-        cmd = cmd + (" " * int(CMD_FIELD_LENGTH - len(cmd)))  # Change cmd to cmd and space's chars until len is 16
-        data_length = ""  # Also create a variable for data length in format of "0004" for example
-        if len(data) < 10:  # Adding zeros to data's 'length depend what size is it
-            data_length = "000" + str(len(data))
-        elif len(data) < 100:
-            data_length = "00" + str(len(data))
-        elif len(data) < 1000:
-            data_length = "0" + str(len(data))
-        elif len(data) < 10000:
-            data_length = str(len(data))
-        full_msg = cmd + DELIMITER + data_length + DELIMITER + data  # Returns all msg separated by "|"
-        return full_msg
+    data_size = len(data.encode())  # The length field counts encoded bytes, so the receiver can frame the stream
+    if len(cmd) <= CMD_FIELD_LENGTH and data_size <= MAX_DATA_LENGTH:  # If cmd and data lengths are allowed:
+        # cmd padded with spaces to 16 chars, data's length padded with zeros to 4 digits, all separated by "|"
+        return cmd.ljust(CMD_FIELD_LENGTH) + DELIMITER + str(data_size).zfill(LENGTH_FIELD_LENGTH) + DELIMITER + data
     else:
         return None
 
@@ -71,23 +86,79 @@ def parse_message(data):
     :rtype: tuple
     """
     data = str(data)  # Make sure variable "data" is string
-    if data == "":  # Make sure variable "data" isn't empty
+    if len(data) < MSG_HEADER_LENGTH:  # Make sure variable "data" has a whole header
         return None, None
-    if not data[16] == DELIMITER and data[21] == DELIMITER:  # if data not includes | in the right index, then None
+    if data[CMD_FIELD_LENGTH] != DELIMITER or data[MSG_HEADER_LENGTH - 1] != DELIMITER:  # | in the right indexes
         return None, None
-    parse_message_list = data.split(DELIMITER)  # A list made from data separated by |
-    cmd = parse_message_list[0].replace(" ", "")  # Cmd = cmd without spaces
-    data_length = parse_message_list[1].replace(" ", "")  # Data's length = itself without spaces
-    if not data_length.isnumeric():  # Make sure Data's length is number only
+    cmd = data[:CMD_FIELD_LENGTH].strip()  # The fields have fixed places, so a | inside the data doesn't matter
+    data_length = data[CMD_FIELD_LENGTH + 1:MSG_HEADER_LENGTH - 1].strip()
+    if not (data_length.isascii() and data_length.isdigit()):  # Make sure Data's length is number only
         return None, None
-    msg = parse_message_list[2]  # msg = msg
-    # If cmd, data length, msg - all lengths are allowed then returns separated massage, else None:
-    if len(cmd) <= CMD_FIELD_LENGTH and len(msg) <= MAX_DATA_LENGTH and len(data_length) <= LENGTH_FIELD_LENGTH:
+    msg = data[MSG_HEADER_LENGTH:]
+    if len(msg) <= MAX_DATA_LENGTH:  # If msg length is allowed then returns separated massage, else None
         return cmd, msg
     else:
         return None, None
 
 
+def build_binary_message(cmd, data):
+    """
+    Gets command name (str) and data field (str) and creates a binary protocol message
+    :param cmd: A command name
+    :type cmd: str
+    :param data: A data field
+    :type data: str
+    return: the encoded message, or None if the command is unknown or the data is too long
+    :rtype: bytes, or None
+    """
+    code = COMMAND_CODES.get(cmd)
+    encoded = data.encode()
+    if code is None or len(encoded) > MAX_BINARY_DATA_LENGTH:
+        return None
+    return BINARY_HEADER.pack(code, len(encoded)) + encoded
+
+
+def text_to_binary(message):
+    """
+    Converts an encoded text message to a binary one, without decoding its data field.
+    Used for the replies the server keeps encoded in the text format
+    :param message: an encoded text protocol message
+    :type message: bytes
+    return: the same message in the binary format
+    :rtype: bytes
+    """
+    view = memoryview(message)
+    code = COMMAND_CODES[str(view[:CMD_FIELD_LENGTH], "latin-1").rstrip()]
+    data = view[MSG_HEADER_LENGTH:]
+    return BINARY_HEADER.pack(code, len(data)) + data
+
+
+def parse_binary_message(data):
+    """
+    Parses one whole binary protocol message
+    :param data: an encoded binary message
+    :type data: bytes
+    return: cmd (str) and data (str). If the message is broken returns None, None
+    :rtype: tuple
+    """
+    view = memoryview(data)
+    if len(view) < BINARY_HEADER.size:
+        return None, None
+    code, data_length = BINARY_HEADER.unpack_from(view)
+    if len(view) != BINARY_HEADER.size + data_length:
+        return None, None
+    return command_name(code), str(view[BINARY_HEADER.size:], "utf-8", "replace")
+
+
+def command_name(code):
+    """
+    return: the command of a binary command code, "" for an unknown code - the handlers reject it like an unknown
+    text command
+    :rtype: str
+    """
+    return COMMANDS[code - 1] if 0 < code <= len(COMMANDS) else ""
+
+
 def split_data(msg, expected_fields):
     """
     Helper method. gets a string and number of expected fields in it. Splits the string
@@ -120,3 +191,125 @@ def join_data(msg_fields):
         msg += str(item) + DATA_DELIMITER
     return msg[0:len(msg) - 1]  # Return the whole str separated by "#" without the last one
 
+
+# Batches
+# The data of a BATCH request is several whole text messages one after the other, and so is the data of its
+# BATCH_ANSWER - one reply per request, in the same order.
+
+def join_messages(messages):
+    """
+    Helper method. Gets a list of (cmd, data) tuples and builds the data field of a batch
+    :param messages: the messages of the batch
+    :type messages: list
+    return: the messages one after the other, or None if one of them can't be built
+    :rtype: str, or None
+    """
+    built = [build_message(cmd, data) for cmd, data in messages]
+    if None in built:
+        return None
+    return "".join(built)
+
+
+def split_messages(data):
+    """
+    Helper method. Gets the data field of a batch and splits it to its messages
+    :param data: the data field of a batch
+    :type data: str
+    return: list of (cmd, data) tuples. If a message is broken the last tuple is None, None
+    :rtype: list
+    """
+    framer = MessageFramer(False)
+    framer.feed(data.encode())
+    return list(framer.messages())
+
+
+# Stream Framing
+
+class MessageFramer:
+    """
+    Per-connection buffer that cuts a TCP byte stream into protocol messages.
+    TCP may split one message over several recv() calls or join a few messages into one,
+    so the framer keeps the leftovers and only hands out messages whose header and data fully arrived.
+    """
+
+    def __init__(self, binary=None):
+        """
+        :param binary: the format of the stream. None to choose it by the stream's first byte - the server's side,
+        where a binary stream starts with BINARY_PREAMBLE
+        :type binary: bool, or None
+        """
+        self._buffer = bytearray()  # Bytes received and not framed yet
+        self._start = 0  # Index of the first byte of the next message in the buffer
+        self.binary = binary
+
+    def feed(self, data):
+        """
+        Adds received bytes to the buffer
+        :param data: bytes received from the socket
+        :type data: bytes
+        Returns: None
+        """
+        if self._start:  # Drop the consumed bytes once per recv, not once per message
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+    def next_message(self):
+        """
+        Takes the next complete message out of the buffer
+        return: cmd (str) and data (str) of the message, None if no complete message is buffered yet.
+        If the header is broken returns None, None and the rest of the stream is dropped
+        :rtype: tuple, or None
+        """
+        if self.binary is None:  # The first bytes of the stream choose its format
+            if len(self._buffer) == 0:
+                return None
+            self.binary = self._buffer[0] == BINARY_PREAMBLE[0]
+            if self.binary:
+                self._start = len(BINARY_PREAMBLE)
+        if self.binary:
+            return self._next_binary_message()
+        start = self._start
+        if len(self._buffer) - start < MSG_HEADER_LENGTH:  # The header didn't fully arrive yet
+            return None
+        header = self._buffer[start:start + MSG_HEADER_LENGTH].decode("latin-1")  # One char per byte, never fails
+        data_length = header[CMD_FIELD_LENGTH + 1:MSG_HEADER_LENGTH - 1]
+        # isdigit() alone takes digits like "\xb2" that int() rejects
+        if header[CMD_FIELD_LENGTH] != DELIMITER or header[-1] != DELIMITER or not data_length.isascii() \
+                or not data_length.isdigit():
+            self._buffer.clear()  # There is no way to find the next message after a broken header
+            self._start = 0
+            return None, None
+        end = start + MSG_HEADER_LENGTH + int(data_length)
+        if len(self._buffer) < end:  # The data field didn't fully arrive yet
+            return None
+        cmd = header[:CMD_FIELD_LENGTH].strip()
+        with memoryview(self._buffer) as view:  # Decoded straight from the buffer, without copying the slice
+            data = str(view[start + MSG_HEADER_LENGTH:end], "utf-8", "replace")
+        self._start = end
+        return cmd, data
+
+    def _next_binary_message(self):
+        start = self._start
+        if len(self._buffer) - start < BINARY_HEADER.size:  # The header didn't fully arrive yet
+            return None
+        code, data_length = BINARY_HEADER.unpack_from(self._buffer, start)
+        end = start + BINARY_HEADER.size + data_length
+        if len(self._buffer) < end:  # The data field didn't fully arrive yet
+            return None
+        with memoryview(self._buffer) as view:  # Released before the next feed() resizes the buffer
+            data = str(view[start + BINARY_HEADER.size:end], "utf-8", "replace")
+        self._start = end
+        return command_name(code), data
+
+    def messages(self):
+        """
+        Yields every complete message in the buffer, so one recv() can serve many pipelined requests
+        return: generator of cmd (str) and data (str) tuples
+        """
+        message = self.next_message()
+        while message is not None:
+            yield message
+            if message == (None, None):  # Nothing can be framed after a broken header
+                return
+            message = self.next_message()
@@ -1,8 +1,16 @@
 import socket
+from collections import deque
 import chatlib  # To use chatlib functions or consts, use chatlib.****
 
 SERVER_IP = "127.0.0.1"  # Our server will run on same computer as client
 SERVER_PORT = 5678
+RECV_BUFFER_SIZE = 4096  # Bytes read per recv, longer messages are put together by the framer
+DEBUG_PRINTS = True  # Print every sent and received message. The load generator turns it off
+
+PUSH_COMMANDS = ("ROOM_QUESTION", "ROUND_OVER")  # Sent by the server on its own, never as a reply to a request
+
+framers = {}  # A dictionary of sockets to their chatlib.MessageFramer
+pushed = {}  # A dictionary of sockets to a deque of the pushed messages that arrived while waiting for a reply
 
 
 # HELPER SOCKET METHODS
@@ -18,39 +26,100 @@ def build_and_send_message(conn, code, data):
     :type data: str
     Returns: Nothing
     """
+    framer = framers.get(conn)
+    if framer is not None and framer.binary:  # The socket was connected in the binary format
+        conn.send(chatlib.build_binary_message(code, data))
+        if DEBUG_PRINTS:
+            print("[CLIENT] ", code, data)  # Debug print
+        return
     full_msg = chatlib.build_message(code, data)
     conn.send(full_msg.encode())  # Change the text to binary code
-    print("[CLIENT] ", full_msg)  # Debug print
+    if DEBUG_PRINTS:
+        print("[CLIENT] ", full_msg)  # Debug print
     # print("The massage was sent successfully to server.")
 
 
 def recv_message_and_parse(conn):
     """
     Receives a new message from given socket, then parses the message using chatlib.
+    Reads from the socket until one full reply arrived, extra bytes are kept for the next call.
+    Pushed messages that arrive before it are kept for recv_push
     :param conn: an opened socket from the connect method.
     :type conn: socket
     return: cmd (str) and data (str) of the received message. If error occurred, will return None, None
     """
-    # Receive the data from the server - until 1024 bytes.
-    msg_code = conn.recv(1024)  # Receive coded massage from the server.
-    msg = msg_code.decode()  # Change the massage code to text by decode().
-    cmd, data = chatlib.parse_message(msg)  # Parses protocol message and returns command name and data field.
-    if cmd == "ALL_SCORE":
-        print("[SERVER] " + msg.replace(data, ""))  # Debug print
+    cmd, data = recv_any_message(conn)
+    while cmd in PUSH_COMMANDS:
+        pushed.setdefault(conn, deque()).append((cmd, data))
+        cmd, data = recv_any_message(conn)
+    return cmd, data
+
+
+def recv_push(conn):
+    """
+    Waits for the next message the server pushes, e.g. the question of the room's round
+    :param conn: an opened socket from the connect method.
+    :type conn: socket
+    return: cmd (str) and data (str) of the pushed message. If error occurred, will return None, None
+    """
+    waiting = pushed.get(conn)
+    if waiting:
+        return waiting.popleft()
+    return recv_any_message(conn)
+
+
+def recv_any_message(conn):
+    """
+    Receives the next message from the socket, a reply or a pushed one
+    :param conn: an opened socket from the connect method.
+    :type conn: socket
+    return: cmd (str) and data (str) of the received message. If error occurred, will return None, None
+    """
+    framer = framers.setdefault(conn, chatlib.MessageFramer(False))  # Keeps the leftovers of partial messages
+    message = framer.next_message()
+    while message is None:  # Receive until the header and the whole data field arrived
+        msg_code = conn.recv(RECV_BUFFER_SIZE)  # Receive coded massage from the server.
+        if msg_code == b"":  # The server closed the connection
+            return None, None
+        framer.feed(msg_code)
+        message = framer.next_message()
+    cmd, data = message
+    if not DEBUG_PRINTS:
+        pass
+    elif cmd == "ALL_SCORE":
+        print("[SERVER] ", cmd)  # Debug print
     else:
-        print("[SERVER] ", msg)  # Debug print
+        print("[SERVER] ", cmd, data)  # Debug print
     return cmd, data
 
 
-def connect():
-    """  Uses the constant ip, port and creates a connected socket. """
+def connect(binary=False):
+    """
+    Uses the constant ip, port and creates a connected socket.
+    :param binary: True to talk with the server in the binary format instead of the text one
+    :type binary: bool
+    """
     # Create a socket object
     # Insert to it IP protocol (AF_INET), and then TCP protocol (SOCK_STREAM)
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((SERVER_IP, SERVER_PORT))  # Connect to server using local host
+    if binary:
+        client_socket.send(chatlib.BINARY_PREAMBLE)  # Tells the server the format of this connection
+    framers[client_socket] = chatlib.MessageFramer(binary)
     return client_socket
 
 
+def close(conn):
+    """
+    Closes the socket and forgets its unframed bytes
+    :param conn: an opened socket from the connect method.
+    :type conn: socket
+    """
+    framers.pop(conn, None)
+    pushed.pop(conn, None)
+    conn.close()
+
+
 def error_and_exit(error_msg):
     """
     Exits from the server in case of trouble issues
@@ -109,6 +178,56 @@ def build_send_recv_parse(conn, code, data):
     return msg_code, data
 
 
+def build_send_recv_pipelined(conn, requests):
+    """
+    Sends several requests at once, then receives their replies - in the same order, the server answers every
+    request but LOGOUT. Costs one round trip instead of one per request.
+    :param conn: an opened socket from the connect method.
+    :type conn: socket
+    :param requests: list of (code, data) tuples
+    :type requests: list
+    return: list of the (cmd, data) replies. If an error occurred, the last reply is None, None
+    """
+    framer = framers.get(conn)
+    if framer is not None and framer.binary:
+        messages = [chatlib.build_binary_message(code, data) for code, data in requests]
+    else:
+        messages = [chatlib.build_message(code, data) for code, data in requests]
+        messages = [message.encode() for message in messages if message is not None]
+    if len(messages) != len(requests) or None in messages:  # One of the requests can't be built
+        return [(None, None)]
+    conn.sendall(b"".join(messages))
+    for code, data in requests:
+        if DEBUG_PRINTS:
+            print("[CLIENT] ", code, data)  # Debug print
+    replies = []
+    for _ in requests:
+        reply = recv_message_and_parse(conn)
+        replies.append(reply)
+        if reply == (None, None):
+            break
+    return replies
+
+
+def build_send_recv_batch(conn, requests):
+    """
+    Sends several requests in one BATCH message, and splits the BATCH_ANSWER to their replies.
+    LOGOUT and BATCH can't be sent in a batch.
+    :param conn: an opened socket from the connect method.
+    :type conn: socket
+    :param requests: list of (code, data) tuples
+    :type requests: list
+    return: list of the (cmd, data) replies in the order of the requests. If error occurred, list of one None, None
+    """
+    batch_data = chatlib.join_messages(requests)
+    if batch_data is None:
+        return [(None, None)]
+    msg_code, data = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["batch_msg"], batch_data)
+    if msg_code != "BATCH_ANSWER":
+        return [(None, None)]
+    return chatlib.split_messages(data)
+
+
 def get_score(conn):
     """
     Prints the client points by his user details
@@ -135,6 +254,19 @@ def get_highscore(conn):
         print("\nHigh-Score table:" + str(recv_message[1]) + "\n")
 
 
+def get_rank(conn):
+    """
+    Prints the client's place in the high-score table.
+    :param conn:
+    :type conn: socket
+    """
+    recv_message = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["my_rank_msg"], "")
+    if recv_message == (None, None) or recv_message[0] == "ERROR":
+        print("An error occurred.\n")
+    else:
+        print("Your place is " + str(recv_message[1]) + ".\n")
+
+
 def user_options():
     """
     Prints the available options to the user
@@ -142,7 +274,11 @@ def user_options():
     print("""    p    Play a trivia question
     s    Get my score
     h    Get high score
+    r    Get my place
     l    Get logged users
+    a    Get all of the above
+    t    Get server stats
+    m    Play in a room with other players
     q    Quit""")
 
 
@@ -184,6 +320,79 @@ def play_question(conn):
             print("YES!!!!\n")
 
 
+def play_room(conn):
+    """
+    Joins a room and plays its rounds - every player of the room gets the same question, the first to answer
+    it right wins the round
+    :param conn:
+    :type conn: socket
+    """
+    room_name = input("Please enter room name: ")
+    recv_message = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["join_room_msg"], room_name)
+    if recv_message == (None, None) or recv_message[0] != "ROOM_JOINED":
+        print("An error occurred.\n")
+        return
+    print("Joined room " + room_name + ", " + chatlib.split_data(recv_message[1], 1)[1] + " players in it.")
+    print("Waiting for the next round...\n")
+    while True:
+        cmd, data = recv_push(conn)
+        if cmd is None:
+            print("An error occurred.\n")
+            return
+        if cmd == "ROUND_OVER":
+            winner, correct = chatlib.split_data(data, 1)
+            print("Round over! The correct answer is " + correct + ".")
+            print((winner + " won the round." if winner else "Nobody got it right.") + "\n")
+            if input("Play another round? (y/n) ").upper() != "Y":
+                break
+            continue
+        question_list = chatlib.split_data(data, 5)  # Same fields as YOUR_QUESTION
+        print("\nQ: " + question_list[1])
+        for number, answer in enumerate(question_list[2:6], 1):
+            print("    " + str(number) + ".  " + answer)
+        chosen_answer = input("\nPlease enter your choice:")
+        recv_message = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["send_answer_msg"],
+                                             question_list[0] + "#" + chosen_answer)
+        if recv_message[0] == "CORRECT_ANSWER":
+            print("YES!!!! You were the first.\n")
+        elif recv_message[0] == "WRONG_ANSWER":
+            print("Nope.\n")
+        else:
+            print("Too late.\n")
+    build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["leave_room_msg"], "")
+    pushed.pop(conn, None)  # The room's messages that arrived meanwhile
+
+
+def get_summary(conn):
+    """
+    Prints the client's score, the high-score table and the logged users - fetched together in one batch
+    :param conn:
+    :type conn: socket
+    """
+    replies = build_send_recv_batch(conn, [(chatlib.PROTOCOL_CLIENT["my_score_msg"], ""),
+                                           (chatlib.PROTOCOL_CLIENT["highscore_msg"], ""),
+                                           (chatlib.PROTOCOL_CLIENT["logged_msg"], "")])
+    if len(replies) != 3 or (None, None) in replies:
+        print("An error occurred.\n")
+        return
+    print("Your score is " + replies[0][1] + ".")
+    print("High-Score table:" + replies[1][1])
+    print("Logged users: " + replies[2][1] + "\n")
+
+
+def get_stats(conn):
+    """
+    Prints the server's counters and per-command latencies
+    :param conn:
+    :type conn: socket
+    """
+    recv_message = build_send_recv_parse(conn, chatlib.PROTOCOL_CLIENT["stats_msg"], "")
+    if recv_message == (None, None) or recv_message[0] == "ERROR":
+        print("An error occurred.\n")
+    else:
+        print("\nServer stats:\n" + recv_message[1] + "\n")
+
+
 def get_logged_users(conn):
     """
     Ask for a question from server
@@ -206,8 +415,16 @@ def main():
             get_score(client_socket)
         elif chosen_action_of_user == "H":
             get_highscore(client_socket)
+        elif chosen_action_of_user == "R":
+            get_rank(client_socket)
         elif chosen_action_of_user == "L":
             get_logged_users(client_socket)
+        elif chosen_action_of_user == "A":
+            get_summary(client_socket)
+        elif chosen_action_of_user == "T":
+            get_stats(client_socket)
+        elif chosen_action_of_user == "M":
+            play_room(client_socket)
         elif chosen_action_of_user == "P":
             play_question(client_socket)
         elif chosen_action_of_user == "Q":
@@ -0,0 +1,387 @@
+##############################################################################
+# event_loop.py
+##############################################################################
+import logging
+import math
+import selectors
+import socket
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ACCEPT_BATCH = 64  # Max connections accepted on one readable event of a listening socket
+ACCEPT_RETRY_DELAY = 1  # Seconds the listener stops accepting after an accept error, e.g. out of file descriptors
+TIMER_TICK = 0.5  # Seconds per slot of the timer wheel - timers fire up to one tick late
+TIMER_SLOTS = 256  # Slots of the timer wheel, one turn of the wheel is TIMER_TICK * TIMER_SLOTS seconds
+EXECUTOR_WORKERS = 4  # Threads running the blocking jobs of the loop
+
+log = logging.getLogger("trivia.event_loop")
+
+
+class Timer:
+    __slots__ = ("callback", "rounds", "slot")
+
+    def __init__(self, callback, rounds, slot):
+        self.callback = callback
+        self.rounds = rounds  # Turns of the wheel left before it fires
+        self.slot = slot  # The wheel's slot it waits in, None after it fired or was cancelled
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: a timer waits in the slot of its tick, with the number of whole turns of the wheel left.
+    Adding and cancelling cost O(1), and every tick looks only at the timers of one slot - so thousands of
+    idle timeouts and answer deadlines cost the loop almost nothing until they are due.
+    """
+
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_SLOTS, now=None):
+        self._tick = tick
+        self._slots = [set() for _ in range(slots)]  # Sets of Timers, so a cancel doesn't search its slot
+        self._current = 0  # The last tick that was handled
+        self._next_tick_time = (time.monotonic() if now is None else now) + tick
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, now=None):
+        """
+        Calls callback() after delay seconds, at the first tick after it
+        :param delay: seconds
+        :type delay: float
+        :param callback: function without arguments
+        :type callback: function
+        :param now: time.monotonic() of the call
+        :type now: float
+        return: the timer, for cancel()
+        :rtype: Timer
+        """
+        if now is None:
+            now = time.monotonic()
+        # Counted from the time of the next tick, not from _current - the wheel may be behind until the next
+        # advance(), e.g. after the loop slept with no timers, and the ticks it catches up on mustn't count
+        ticks = max(1, 1 + math.ceil((now + delay - self._next_tick_time) / self._tick))
+        slot = (self._current + ticks) % len(self._slots)
+        timer = Timer(callback, (ticks - 1) // len(self._slots), slot)
+        self._slots[slot].add(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            self._slots[timer.slot].discard(timer)
+            timer.slot = None
+            self._count -= 1
+
+    def next_timeout(self, now=None):
+        """
+        return: seconds until the next tick, or None if no timer waits
+        :rtype: float, or None
+        """
+        if self._count == 0:
+            return None
+        return max(0.0, self._next_tick_time - (time.monotonic() if now is None else now))
+
+    def advance(self, now=None):
+        """
+        Handles every tick that passed, calling the timers that are due
+        :param now: time.monotonic() of the call
+        :type now: float
+        Returns: None
+        """
+        if now is None:
+            now = time.monotonic()
+        while self._next_tick_time <= now:
+            self._next_tick_time += self._tick
+            self._current += 1
+            if self._count == 0:  # Nothing to fire - just keep the wheel's position
+                continue
+            slot_index = self._current % len(self._slots)
+            due = []
+            for timer in self._slots[slot_index]:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    due.append(timer)
+            for timer in due:
+                self._slots[slot_index].discard(timer)
+                timer.slot = None
+                self._count -= 1
+            for timer in due:  # Called after the slot is updated, so callbacks may add or cancel timers
+                timer.callback()
+
+
+class Executor:
+    """
+    Runs blocking jobs (network requests, file writes) on a thread pool and calls their callbacks back on the
+    loop's thread. A finished job wakes the loop up through a socket pair registered as one of its readers,
+    so the loop never polls for results and never waits for a job.
+    """
+
+    def __init__(self, loop, workers=EXECUTOR_WORKERS):
+        """
+        :param loop: the loop the callbacks are called on
+        :type loop: EventLoop
+        :param workers: threads of the pool
+        :type workers: int
+        """
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="loop-executor")
+        self._done = deque()  # (callback, future) of the finished jobs. Appended by the pool's threads
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()  # A self-pipe that works on Windows too
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.pending = 0  # Jobs submitted and not called back yet
+        loop.add_reader(self._wakeup_reader, self._on_wakeup)
+
+    def submit(self, job, callback):
+        """
+        Runs job() on the pool, then callback(future) on the loop's thread
+        :param job: blocking function without arguments
+        :type job: function
+        :param callback: function that gets the job's concurrent.futures.Future - its result() returns the job's
+        return value or raises its exception
+        :type callback: function
+        Returns: None
+        """
+        self.pending += 1
+        self._pool.submit(job).add_done_callback(lambda future: self._finished(callback, future))
+
+    def _finished(self, callback, future):
+        """
+        Called on the pool's thread when a job is done
+        """
+        self._done.append((callback, future))
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):  # The socket is full of wakeups, the loop is woken up anyway
+            pass
+
+    def _on_wakeup(self, sock):
+        try:
+            while sock.recv(4096):  # Drain the wakeups - one turn serves all the jobs done meanwhile
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._done:
+            callback, future = self._done.popleft()
+            self.pending -= 1
+            callback(future)
+
+    def shutdown(self, loop):
+        loop.remove(self._wakeup_reader)
+        self._pool.shutdown(wait=False)
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
+class EventLoop:
+    """
+    Socket event loop built on the selectors module (epoll on Linux, kqueue on BSD/macOS).
+    Unlike select.select(), the kernel keeps the registered sockets between calls, so a wakeup costs
+    O(ready sockets) and idle clients cost nothing. It also works above the ~1024 descriptors of FD_SETSIZE.
+    The selectors backends are level-triggered: a reader doesn't have to drain its socket, the loop calls it
+    again while data is left. Read interest stays registered, write interest is switched on only while a
+    socket has pending data, and the selector is touched only when a socket's interest really changes.
+    """
+
+    def __init__(self, selector_class=selectors.DefaultSelector):
+        """
+        :param selector_class: the selectors backend, e.g. selectors.EpollSelector or selectors.SelectSelector
+        :type selector_class: type
+        """
+        self._selector = selector_class()
+        self._readers = {}  # A dictionary of sockets to the function called when they are readable
+        self._writers = {}  # A dictionary of sockets to the function called when they are writable
+        self._paused = set()  # Sockets whose read interest is switched off for now
+        self._registered = {}  # A dictionary of sockets to (fd, mask) as registered in the selector
+        self._soon = deque()  # Functions to call on the next turn, after the ready sockets
+        self.running = False
+        self.turn_time = None  # metrics.Histogram of the seconds every turn spends handling ready sockets
+        self.timers = TimerWheel()  # Timeouts, checked on every turn
+        self._executor = None  # Executor of the blocking jobs, created on the first one
+
+    def __len__(self):
+        return len(self._registered)
+
+    def _update(self, sock):
+        """
+        Registers, modifies or unregisters the socket, only if its wanted events changed
+        :param sock: a socket handled by the loop
+        :type sock: socket
+        Returns: None
+        """
+        mask = 0
+        if sock in self._readers and sock not in self._paused:
+            mask |= selectors.EVENT_READ
+        if sock in self._writers:
+            mask |= selectors.EVENT_WRITE
+        fd, old_mask = self._registered.get(sock, (None, 0))
+        if mask == old_mask:
+            return
+        if fd is None:
+            fd = sock.fileno()
+            self._selector.register(fd, mask, sock)
+        elif mask == 0:
+            self._selector.unregister(fd)
+            del self._registered[sock]
+            return
+        else:
+            self._selector.modify(fd, mask, sock)
+        self._registered[sock] = (fd, mask)
+
+    def add_reader(self, sock, callback):
+        """
+        Calls callback(sock) whenever the socket is readable, until remove() is called
+        :param sock: a non-blocking socket
+        :type sock: socket
+        :param callback: function that gets the socket
+        :type callback: function
+        Returns: None
+        """
+        self._readers[sock] = callback
+        self._update(sock)
+
+    def add_listener(self, server_socket, on_accept):
+        """
+        Accepts new clients in batches - up to ACCEPT_BATCH connections per readable event
+        :param server_socket: a listening socket
+        :type server_socket: socket
+        :param on_accept: function that gets the client socket and its address
+        :type on_accept: function
+        Returns: None
+        """
+        server_socket.setblocking(False)
+
+        def accept_clients(sock):
+            for _ in range(ACCEPT_BATCH):
+                try:
+                    client_socket, client_address = sock.accept()
+                except (BlockingIOError, InterruptedError):  # No more waiting connections
+                    return
+                except OSError as error:  # E.g. out of file descriptors - keep serving the connected clients
+                    # The waiting connection keeps the listener readable - without a pause the loop would spin
+                    log.error("Accept failed: %s, pausing accepts for %s s", error, ACCEPT_RETRY_DELAY)
+                    self.pause_reading(sock)
+                    self.timers.call_later(ACCEPT_RETRY_DELAY, lambda: self.resume_reading(sock))
+                    return
+                on_accept(client_socket, client_address)
+
+        self.add_reader(server_socket, accept_clients)
+
+    def set_writer(self, sock, callback):
+        """
+        Calls callback(sock) whenever the socket is writable, until clear_writer() is called
+        :param sock: a non-blocking socket
+        :type sock: socket
+        :param callback: function that gets the socket
+        :type callback: function
+        Returns: None
+        """
+        if self._writers.get(sock) is callback:
+            return
+        self._writers[sock] = callback
+        self._update(sock)
+
+    def clear_writer(self, sock):
+        """
+        Stops the write interest of the socket, e.g. after all its pending data was sent
+        """
+        if self._writers.pop(sock, None) is not None:
+            self._update(sock)
+
+    def pause_reading(self, sock):
+        """
+        Stops the read interest of the socket until resume_reading() - used for back-pressure
+        """
+        if sock not in self._paused:
+            self._paused.add(sock)
+            self._update(sock)
+
+    def resume_reading(self, sock):
+        if sock in self._paused:
+            self._paused.discard(sock)
+            self._update(sock)
+
+    def is_reading_paused(self, sock):
+        return sock in self._paused
+
+    def call_soon(self, callback):
+        """
+        Calls callback() on the next turn of the loop, after the sockets that are ready then -
+        e.g. to go on with buffered work of one client after the others had their turn
+        :param callback: function without arguments
+        :type callback: function
+        Returns: None
+        """
+        self._soon.append(callback)
+
+    def run_in_executor(self, job, callback):
+        """
+        Runs the blocking job on a thread of the loop's Executor, and callback(future) on the loop when it's done
+        :param job: blocking function without arguments
+        :type job: function
+        :param callback: function that gets the job's concurrent.futures.Future
+        :type callback: function
+        Returns: None
+        """
+        if self._executor is None:
+            self._executor = Executor(self)
+        self._executor.submit(job, callback)
+
+    def remove(self, sock):
+        """
+        Forgets the socket. Works also if the socket was already closed, because the fd is kept from registration
+        :param sock: a socket handled by the loop
+        :type sock: socket
+        Returns: None
+        """
+        self._readers.pop(sock, None)
+        self._writers.pop(sock, None)
+        self._paused.discard(sock)
+        fd, mask = self._registered.pop(sock, (None, 0))
+        if fd is not None:
+            self._selector.unregister(fd)
+
+    def run_once(self, timeout=None):
+        """
+        Waits for ready sockets and calls their functions
+        :param timeout: max seconds to wait, None for no limit
+        :type timeout: float, or None
+        Returns: None
+        """
+        if self._soon:  # Don't sleep while there is work waiting
+            timeout = 0
+        else:
+            timer_timeout = self.timers.next_timeout()
+            if timer_timeout is not None and (timeout is None or timer_timeout < timeout):
+                timeout = timer_timeout  # Wake up for the next tick of the timers
+        ready = self._selector.select(timeout)
+        start = time.perf_counter()
+        for key, events in ready:
+            sock = key.data
+            if events & selectors.EVENT_READ:
+                callback = self._readers.get(sock)
+                if callback is not None and sock not in self._paused:
+                    callback(sock)
+            if events & selectors.EVENT_WRITE:
+                callback = self._writers.get(sock)  # The reader may have removed the socket meanwhile
+                if callback is not None:
+                    callback(sock)
+        for _ in range(len(self._soon)):  # Only what was waiting before this turn, new calls wait for the next one
+            self._soon.popleft()()
+        self.timers.advance()
+        if self.turn_time is not None and ready:
+            self.turn_time.record(time.perf_counter() - start)
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(self)
+        self._selector.close()
@@ -0,0 +1,174 @@
+##############################################################################
+# leaderboard.py
+##############################################################################
+import math
+import random
+
+MAX_LEVELS = 32  # Enough skip list levels for 2 ** 32 users
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key  # (-score, username), so the ascending order of the keys is the leaderboard order
+        self.next = [None] * levels  # The next node on every level
+        self.width = [1] * levels  # How many positions every link skips - used to count ranks
+
+
+_LAST = _Node((math.inf, ""), 0)  # The end of every level, its key is bigger than any (-score, username)
+
+
+class Leaderboard:
+    """
+    Users ordered by score (and by name between equal scores), kept in an indexable skip list.
+    A score change, a "my rank" query and the first node of a top-K query all cost O(log n) -
+    no sort of the whole user table per HIGHSCORE.
+    """
+
+    def __init__(self, scores=(), watched_top=5):
+        """
+        :param scores: pairs of username and score
+        :type scores: iterable
+        :param watched_top: top_version changes only when one of the first watched_top places changes
+        :type watched_top: int
+        """
+        self._head = _Node(None, MAX_LEVELS)
+        for level in range(MAX_LEVELS):
+            self._head.next[level] = _LAST
+        self._scores = {}  # A dictionary of usernames to their score
+        self._watched_top = watched_top
+        self.top_version = 0  # Lets callers cache what they built from top(watched_top)
+        self._build(scores)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, username):
+        return username in self._scores
+
+    @staticmethod
+    def _random_levels():
+        return min(MAX_LEVELS, 1 - int(math.log(1.0 - random.random(), 2.0)))  # 1 level, 2 with 1/2, 3 with 1/4...
+
+    def _build(self, scores):
+        """
+        Links all the users at once from their sorted keys - O(n) after the sort, instead of n inserts
+        """
+        self._scores = dict(scores)
+        keys = sorted((-score, username) for username, score in self._scores.items())
+        last_at_level = [self._head] * MAX_LEVELS  # The last linked node of every level
+        last_position = [0] * MAX_LEVELS
+        for position, key in enumerate(keys, 1):
+            node = _Node(key, self._random_levels())
+            for level in range(len(node.next)):
+                previous = last_at_level[level]
+                previous.next[level] = node
+                previous.width[level] = position - last_position[level]
+                last_at_level[level] = node
+                last_position[level] = position
+        for level in range(MAX_LEVELS):
+            last_at_level[level].next[level] = _LAST
+            last_at_level[level].width[level] = len(keys) + 1 - last_position[level]
+
+    def _find(self, key, chain):
+        """
+        Walks to the last node before key on every level
+        :param chain: filled with that node of every level
+        :type chain: list
+        return: the position of the node before key on the lowest level (0 is the head)
+        :rtype: int
+        """
+        node = self._head
+        position = 0
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return position
+
+    def _insert(self, key):
+        chain = [None] * MAX_LEVELS
+        steps_at_level = [0] * MAX_LEVELS
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        levels = self._random_levels()
+        new_node = _Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            previous = chain[level]
+            new_node.next[level] = previous.next[level]
+            previous.next[level] = new_node
+            new_node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, MAX_LEVELS):
+            chain[level].width[level] += 1
+        return sum(steps_at_level) + 1  # The new node's rank
+
+    def _remove(self, key):
+        chain = [None] * MAX_LEVELS
+        rank = self._find(key, chain) + 1
+        node = chain[0].next[0]
+        for level in range(len(node.next)):
+            previous = chain[level]
+            previous.width[level] += node.width[level] - 1
+            previous.next[level] = node.next[level]
+        for level in range(len(node.next), MAX_LEVELS):
+            chain[level].width[level] -= 1
+        return rank
+
+    def update(self, username, score):
+        """
+        Sets the user's score, adds the user if needed
+        :param username: the user's name
+        :type username: str
+        :param score: the new score
+        :type score: int
+        Returns: None
+        """
+        old_score = self._scores.get(username)
+        if old_score == score:
+            return
+        old_rank = None
+        if old_score is not None:
+            old_rank = self._remove((-old_score, username))
+        self._scores[username] = score
+        new_rank = self._insert((-score, username))
+        if new_rank <= self._watched_top or (old_rank is not None and old_rank <= self._watched_top):
+            self.top_version += 1
+
+    def remove(self, username):
+        score = self._scores.pop(username, None)
+        if score is not None and self._remove((-score, username)) <= self._watched_top:
+            self.top_version += 1
+
+    def score_of(self, username):
+        return self._scores.get(username)
+
+    def rank(self, username):
+        """
+        return: the user's place, 1 is the highest score. None if the user isn't on the board
+        :rtype: int, or None
+        """
+        score = self._scores.get(username)
+        if score is None:
+            return None
+        return self._find((-score, username), [None] * MAX_LEVELS) + 1
+
+    def top(self, count):
+        """
+        return: list of (username, score) of the count highest scores
+        :rtype: list
+        """
+        result = []
+        node = self._head.next[0]
+        while node is not _LAST and len(result) < count:
+            result.append((node.key[1], -node.key[0]))
+            node = node.next[0]
+        return result
@@ -0,0 +1,211 @@
+##############################################################################
+# loadgen.py
+##############################################################################
+# Headless load generator - many scripted players made of client.py's protocol functions. Every player logs in and
+# sends a random mix of commands, each waiting for its reply, and the latency of every request is recorded.
+# Usage: python loadgen.py [--sessions N] [--requests N] [--processes N] [--mix CMD=WEIGHT,...]
+#                          [--server select|asyncio] [--port PORT] [--binary]
+# Without --port a server with the users user0..user<sessions-1> (password "pass") is started locally.
+import argparse
+import multiprocessing
+import os
+import random
+import threading
+import time
+import chatlib
+import client
+import benchmark
+
+DEFAULT_MIX = "GET_QUESTION=4,SEND_ANSWER=4,HIGHSCORE=1,LOGGED=1,LOGIN=0"
+MIX_COMMANDS = ("LOGIN", "GET_QUESTION", "SEND_ANSWER", "HIGHSCORE", "LOGGED")
+PERCENTILES = (0.5, 0.99, 0.999)
+
+
+def parse_mix(text):
+    """
+    Parses a "CMD=WEIGHT,CMD=WEIGHT" mix. LOGIN in the mix logs out, reconnects and logs in again
+    :param text: the mix
+    :type text: str
+    return: list of (cmd, weight) tuples
+    :rtype: list
+    """
+    mix = []
+    for item in text.split(","):
+        cmd, weight = item.split("=")
+        cmd = cmd.strip().upper()
+        if cmd not in MIX_COMMANDS:
+            raise ValueError("Unknown command in the mix: " + cmd)
+        mix.append((cmd, float(weight)))
+    if sum(weight for cmd, weight in mix) <= 0:
+        raise ValueError("The mix has no weights")
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    """
+    return: the nearest-rank percentile of an ascending list
+    :rtype: float
+    """
+    index = max(0, min(len(sorted_values) - 1, int(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+# PLAYERS
+
+class Player:
+    """
+    One scripted client session. Sends the requests through the client module and records their latencies
+    """
+
+    def __init__(self, username, password, binary):
+        self.username = username
+        self.password = password
+        self.binary = binary
+        self.conn = None
+        self.latencies = {}  # A dictionary of commands to the seconds every request of it took
+        self.errors = 0
+        self.question_id = None  # The id of the last question asked and not answered yet
+
+    def request(self, cmd, data):
+        start = time.perf_counter()
+        reply = client.build_send_recv_parse(self.conn, cmd, data)
+        self.latencies.setdefault(cmd, []).append(time.perf_counter() - start)
+        if reply == (None, None) or reply[0] in ("ERROR", "THROTTLED"):
+            self.errors += 1
+        return reply
+
+    def login(self):
+        self.conn = client.connect(self.binary)
+        return self.request(chatlib.PROTOCOL_CLIENT["login_msg"], self.username + "#" + self.password)
+
+    def logout(self):
+        client.logout(self.conn)
+        client.close(self.conn)
+        self.conn = None
+        self.question_id = None  # The server drops the question of a logged out user
+
+    def get_question(self):
+        reply = self.request(chatlib.PROTOCOL_CLIENT["get_question_msg"], "")
+        if reply[0] == "YOUR_QUESTION":
+            self.question_id = chatlib.split_data(reply[1], 5)[0]
+        return reply
+
+    def send_answer(self):
+        if self.question_id is None:  # Answers need a question first
+            self.get_question()
+            if self.question_id is None:  # No more questions for this user
+                return None
+        data = self.question_id + "#" + str(random.randint(1, 4))
+        self.question_id = None
+        return self.request(chatlib.PROTOCOL_CLIENT["send_answer_msg"], data)
+
+    def run(self, commands, weights, requests_count):
+        """
+        Logs in, sends requests_count requests of the mix one after another and logs out.
+        Stops early if the server closes the connection
+        """
+        try:
+            if self.login()[0] != "LOGIN_OK":
+                return
+            for cmd in random.choices(commands, weights, k=requests_count):
+                if cmd == "LOGIN":
+                    self.logout()
+                    reply = self.login()
+                elif cmd == "GET_QUESTION":
+                    reply = self.get_question()
+                elif cmd == "SEND_ANSWER":
+                    reply = self.send_answer()
+                else:
+                    reply = self.request(cmd, "")
+                if reply == (None, None):
+                    return
+            self.logout()
+        except OSError:
+            self.errors += 1
+
+
+def run_players(port, first_user, sessions_count, requests_count, mix, binary):
+    """
+    Runs sessions_count players on threads of this process. Used as a multiprocessing target
+    return: latencies dictionary of all the players, and their number of errors
+    :rtype: tuple
+    """
+    client.SERVER_IP = benchmark.BENCH_IP
+    client.SERVER_PORT = port
+    client.DEBUG_PRINTS = False
+    commands = [cmd for cmd, weight in mix]
+    weights = [weight for cmd, weight in mix]
+    players = [Player("user" + str(i), "pass", binary) for i in range(first_user, first_user + sessions_count)]
+    threads = [threading.Thread(target=player.run, args=(commands, weights, requests_count)) for player in players]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = {}
+    errors = 0
+    for player in players:
+        for cmd, values in player.latencies.items():
+            latencies.setdefault(cmd, []).extend(values)
+        errors += player.errors
+    return latencies, errors
+
+
+# REPORT
+
+def print_report(latencies, errors, elapsed):
+    print("%-14s %9s %10s %9s %9s %9s" % ("command", "requests", "req/s", "p50 ms", "p99 ms", "p999 ms"))
+    total = 0
+    for cmd in sorted(latencies):
+        values = sorted(latencies[cmd])
+        total += len(values)
+        print("%-14s %9d %10.0f %9.2f %9.2f %9.2f" % ((cmd, len(values), len(values) / elapsed) +
+                                                     tuple(percentile(values, p) * 1000 for p in PERCENTILES)))
+    print("%-14s %9d %10.0f   %.2f s, %d errors" % ("total", total, total / elapsed, elapsed, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the trivia server")
+    parser.add_argument("--sessions", type=int, default=1000, help="concurrent players")
+    parser.add_argument("--requests", type=int, default=100, help="requests of every player")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="processes the players are spread on")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of the commands, CMD=WEIGHT,...")
+    parser.add_argument("--server", choices=("select", "asyncio"), default="select", help="the server to start")
+    parser.add_argument("--port", type=int, help="load a running server instead of starting one")
+    parser.add_argument("--binary", action="store_true", help="use the binary message format")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    server = None
+    port = args.port
+    if port is None:
+        port = benchmark.free_port()
+        server = multiprocessing.Process(target=benchmark.run_server, args=(args.server, port, args.sessions),
+                                         daemon=True)
+        server.start()
+        benchmark.wait_for_port(port)
+    try:
+        processes_count = max(1, min(args.processes, args.sessions))
+        shares = [args.sessions // processes_count + (1 if i < args.sessions % processes_count else 0)
+                  for i in range(processes_count)]
+        jobs = [(port, sum(shares[:i]), shares[i], args.requests, mix, args.binary) for i in range(processes_count)]
+        start = time.perf_counter()
+        with multiprocessing.Pool(processes_count) as pool:
+            results = pool.starmap(run_players, jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    latencies = {}
+    errors = 0
+    for process_latencies, process_errors in results:
+        for cmd, values in process_latencies.items():
+            latencies.setdefault(cmd, []).extend(values)
+        errors += process_errors
+    print(str(args.sessions) + " sessions, " + str(args.requests) + " requests each, mix " + args.mix)
+    print_report(latencies, errors, elapsed)
+
+
+if __name__ == '__main__':
+    main()
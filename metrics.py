@@ -0,0 +1,110 @@
+##############################################################################
+# metrics.py
+##############################################################################
+import math
+import time
+
+SUB_BUCKETS = 4  # Buckets per power of 2, so a bucket is at most 25% wider than its lower bound
+MAX_EXPONENT = 40  # 2 ** 40 microseconds is 12 days - anything longer goes to the last bucket
+REPORT_PERCENTILES = (0.5, 0.99, 0.999)
+
+
+class Histogram:
+    """
+    Latency histogram with log-spaced buckets of microseconds. record() is O(1) and the memory is fixed,
+    however many values are recorded - so it can stay on for every request.
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * ((MAX_EXPONENT + 1) * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0.0  # Seconds
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        Adds one value
+        :param seconds: the measured time
+        :type seconds: float
+        Returns: None
+        """
+        micros = seconds * 1000000
+        if micros < 1:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(micros)  # micros = mantissa * 2 ** exponent, 0.5 <= mantissa < 1
+            index = min(exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @staticmethod
+    def _upper_bound(index):
+        exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+        if exponent == 0:
+            return 0.000001
+        return 2 ** (exponent - 1) * (1 + (sub_bucket + 1) / SUB_BUCKETS) / 1000000
+
+    def percentile(self, fraction):
+        """
+        return: the upper bound of the bucket that holds the given fraction of the values, in seconds
+        :rtype: float
+        """
+        if self.count == 0:
+            return 0.0
+        wanted = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Counters and latency histograms of one server process. Updated on the serving thread only
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}  # A dictionary of commands to the Histogram of their handling time, it counts them too
+        self.counters = {}  # A dictionary of event names to their count, e.g. bytes_in, connections
+        self.loop_turns = Histogram()  # Seconds the event loop spent handling the sockets of every turn
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_command(self, cmd, seconds):
+        histogram = self.commands.get(cmd)
+        if histogram is None:
+            histogram = self.commands[cmd] = Histogram()
+        histogram.record(seconds)
+
+    def report(self, gauges=()):
+        """
+        Builds the text of the STATS reply
+        :param gauges: (name, value) pairs measured right now, e.g. the clients' pending reply bytes
+        :type gauges: iterable
+        return: one line per counter, gauge, command and the event loop's turns
+        :rtype: str
+        """
+        uptime = time.time() - self.started
+        lines = ["uptime %.0f s" % uptime]
+        for name, value in sorted(self.counters.items()):
+            lines.append("%s %d" % (name, value))
+        for name, value in gauges:
+            lines.append("%s %d" % (name, value))
+        lines.append("command count per_s p50_ms p99_ms p999_ms max_ms")
+        histograms = sorted(self.commands.items())
+        if self.loop_turns.count:
+            histograms.append(("(loop turn)", self.loop_turns))
+        for name, histogram in histograms:
+            lines.append("%s %d %.1f %s %.3f" % (name, histogram.count, histogram.count / max(uptime, 1),
+                                                 " ".join("%.3f" % (histogram.percentile(p) * 1000)
+                                                          for p in REPORT_PERCENTILES),
+                                                 histogram.max * 1000))
+        return "\n".join(lines)
@@ -0,0 +1,195 @@
+##############################################################################
+# persistence.py
+##############################################################################
+# Score changes are appended to a log by a background thread - the handlers only queue them in memory.
+# On start the users are loaded from the last snapshot, the log is replayed on top of them, and a new
+# snapshot is written so the log starts empty again.
+import base64
+import os
+import sys
+import threading
+from collections import deque
+import user_store
+
+FLUSH_INTERVAL = 1.0  # Max seconds a score change waits in memory before it is written
+FLUSH_COUNT = 1000  # Write as soon as this many score changes are waiting
+
+
+class ScoreLog:
+    """
+    Write-behind append-only log of score changes. record() costs one deque append on the serving thread,
+    the writing and fsync happen on the log's own thread in batches.
+    Every line is "username,question_id,score" - the score after the change, so replaying a line twice is harmless
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, flush_count=FLUSH_COUNT):
+        self._file = open(path, "a", encoding="utf-8")
+        self._pending = deque()  # Lines not written yet. append and popleft are thread safe
+        self._flush_interval = flush_interval
+        self._flush_count = flush_count
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._lock = threading.Lock()  # Only one flush at a time
+        self._thread = threading.Thread(target=self._run, name="score-log", daemon=True)
+        self._thread.start()
+
+    def record(self, username, question_id, score):
+        """
+        Queues a score change
+        :param username: the user's name
+        :type username: str
+        :param question_id: the question the user answered
+        :param score: the user's score after the answer
+        :type score: int
+        Returns: None
+        """
+        self._pending.append(username + "," + str(question_id) + "," + str(score) + "\n")
+        if len(self._pending) >= self._flush_count:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the queued score changes and syncs them to the disk
+        """
+        with self._lock:
+            count = len(self._pending)
+            if count == 0 or self._file.closed:
+                return
+            lines = [self._pending.popleft() for _ in range(count)]
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+
+BITSET_PREFIX = "@"  # Marks the asked column of a snapshot as a base64 QuestionBitset, older ones list the ids
+
+
+def parse_asked(text):
+    """
+    Parses the asked column of a snapshot line - a base64 bitset, or the ";" separated ids of older snapshots
+    return: the question ids, or None if the user wasn't asked anything
+    :rtype: user_store.QuestionBitset, or None
+    """
+    if not text:
+        return None
+    if text.startswith(BITSET_PREFIX):
+        return user_store.QuestionBitset.from_bytes(base64.b64decode(text[len(BITSET_PREFIX):]))
+    return user_store.QuestionBitset(int(question_id) for question_id in text.split(";")
+                                     if question_id.isascii() and question_id.isdigit())
+
+
+def replay_log(path, users):
+    """
+    Applies the score changes of the log to the users
+    :param path: the log file
+    :type path: str
+    :param users: users dictionary - updated in place
+    :type users: dict
+    return: number of score changes applied
+    :rtype: int
+    """
+    if not os.path.exists(path):
+        return 0
+    applied = 0
+    with open(path, "r", encoding="utf-8") as log_file:
+        for line in log_file:
+            fields = line.rstrip("\n").split(",")
+            if len(fields) != 3 or not fields[2].isascii() or not fields[2].lstrip("-").isdigit():  # Cut by a crash
+                continue
+            user = users.get(fields[0])
+            if user is None:
+                continue
+            user.score = int(fields[2])
+            if fields[1].isascii() and fields[1].isdigit():  # Question ids are ints
+                user.add_asked(int(fields[1]))
+            applied += 1
+    return applied
+
+
+def write_snapshot(path, users):
+    """
+    Saves all the users as "username,password,score,@bitset" lines, the bitset of the asked questions in base64.
+    Written to a temporary file and renamed over the snapshot, so a crash never leaves half a snapshot
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+        for username, user in users.items():
+            asked = user.asked()
+            asked = BITSET_PREFIX + base64.b64encode(asked.to_bytes()).decode("ascii") if len(asked) else ""
+            snapshot_file.write(username + "," + user.password + "," + str(user.score) + "," + asked + "\n")
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_snapshot(path):
+    """
+    return: users dictionary saved by write_snapshot, streamed line by line
+    :rtype: dict
+    """
+    users = {}
+    with open(path, "r", encoding="utf-8") as snapshot_file:
+        for line in snapshot_file:
+            username, password, score, asked = line.rstrip("\n").split(",")
+            users[sys.intern(username)] = user_store.UserRecord(password, int(score), parse_asked(asked))
+    return users
+
+
+def merge_users_file(users, file_users):
+    """
+    Brings the snapshot's users up to date with the users file, which is where users are managed: new users are
+    added, and passwords are taken from the file. Scores and asked questions stay as the snapshot has them
+    :param users: users dictionary of the snapshot - updated in place
+    :type users: dict
+    :param file_users: users dictionary of the users file
+    :type file_users: dict
+    return: number of users added or changed
+    :rtype: int
+    """
+    changed = 0
+    for username, file_user in file_users.items():
+        user = users.get(username)
+        if user is None:
+            users[username] = file_user
+            changed += 1
+        elif user.password != file_user.password:
+            user.password = file_user.password
+            changed += 1
+    return changed
+
+
+def restore_users(snapshot_path, log_path, load_users):
+    """
+    Loads the users from the snapshot merged with the users file (only the file on the first run), replays the log
+    on top, then saves a new snapshot and empties the log. If the server dies between the two, the log is just
+    replayed again
+    :param load_users: function that loads the users file
+    :type load_users: function
+    return: users dictionary
+    :rtype: dict
+    """
+    if os.path.exists(snapshot_path):
+        users = load_snapshot(snapshot_path)
+        changed = merge_users_file(users, load_users())
+    else:
+        users = load_users()
+        changed = len(users)  # No snapshot yet
+    if replay_log(log_path, users):
+        write_snapshot(snapshot_path, users)
+        open(log_path, "w").close()
+    elif changed or not os.path.exists(snapshot_path):
+        write_snapshot(snapshot_path, users)
+    return users
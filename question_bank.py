@@ -0,0 +1,482 @@
+##############################################################################
+# question_bank.py
+##############################################################################
+import html
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import chatlib
+import user_store
+
+OPENTDB_URL = "https://opentdb.com/api.php"  # Replaced by a local fake server in tests
+BATCH_SIZE = 50  # Max questions Open Trivia Database returns per request
+FETCH_WORKERS = 8  # Batches requested in parallel
+FETCH_TIMEOUT = 10  # Seconds to wait for one batch
+RATE_LIMITED = 5  # response_code of a request that came too soon after the last one from the same IP
+RATE_LIMIT_DELAY = 5  # Seconds Open Trivia Database wants between two requests of one IP
+RATE_LIMIT_BUDGET = 30  # Max seconds a fetch waits for the rate limit, the batches still refused are left for later
+
+_versions = itertools.count(1)  # Version numbers of the QuestionBank snapshots, next() is atomic under the GIL
+
+
+def format_question(question_id, info):
+    """
+    :param question_id: the question's id
+    :param info: the question's text, answers and correct answer
+    :type info: dict
+    Returns str of the question id, the question and the answers separated by #
+    """
+    return chatlib.join_data([question_id, info["question"]] + list(info["answers"]))
+
+
+class QuestionBank:
+    """
+    Immutable columnar snapshot of the questions - never changed after it is built, a change builds a new version.
+    Building one costs O(questions), so it is done off the serving thread, and the server swaps it in with one
+    assignment. Questions already asked keep the snapshot they were asked from, so their answers are checked
+    against it even after a reload.
+    Instead of a dictionary per question, every field is a column indexed by the question's place in the bank:
+    one string table holds the encoded YOUR_QUESTION message of every question one after the other, so the
+    question and answer texts are slices of it, and GET_QUESTION sends a slice as it is. Next to it are arrays of
+    the messages' offsets, the texts' offsets inside every message, the correct answers and the ids.
+    """
+    __slots__ = ("version", "question_ids", "_text", "_view", "_offsets", "_fields", "_correct", "_first_id",
+                 "_index", "_id_bits")
+
+    def __init__(self, questions=None, base=None):
+        """
+        :param questions: dictionary of question ids to their text, 4 answers and correct answer (1-4)
+        :type questions: dict
+        :param base: a snapshot whose questions come first, used by extended()
+        :type base: QuestionBank
+        """
+        self.version = next(_versions)  # Every snapshot built later, on any thread, gets a bigger number
+        if base is None:
+            self.question_ids = array("Q")  # The ids in the bank's order, the decks keep indices into it
+            self._offsets = array("Q", [0])  # Offset of every question's message in _text, and the end of the last
+            self._fields = array("H")  # 5 per question - offsets of the question and its answers in its message
+            self._first_id = None  # Ids that go up by one from the first are found by subtraction
+            self._index = None  # Else a dictionary of ids to their index
+            text = bytearray()
+            correct = bytearray()
+        else:
+            self.question_ids = array("Q", base.question_ids)
+            self._offsets = array("Q", base._offsets)
+            self._fields = array("H", base._fields)
+            self._first_id = base._first_id
+            self._index = dict(base._index) if base._index is not None else None
+            text = bytearray(base._text)
+            correct = bytearray(base._correct)
+        for question_id, info in (questions or {}).items():
+            self._add(int(question_id), info, text, correct)  # "7" and 7 are one id
+        self._text = bytes(text)  # The string table
+        self._view = memoryview(self._text)
+        self._correct = bytes(correct)  # The correct answer of every question, 1-4
+        # The ids as a bitset when they aren't dense, so the asked questions of the bank are counted by a popcount
+        self._id_bits = user_store.QuestionBitset(self.question_ids) if self._index is not None else None
+
+    def _add(self, question_id, info, text, correct):
+        answer = int(info["correct"])
+        if len(info["answers"]) != 4 or not 1 <= answer <= 4:
+            raise ValueError("Question " + str(question_id) + " needs 4 answers and a correct answer of 1-4")
+        full_msg = chatlib.build_message("YOUR_QUESTION", format_question(question_id, info))
+        if full_msg is None:
+            raise ValueError("Question " + str(question_id) + " is too long for the protocol")
+        index = len(self.question_ids)
+        if self._first_id is None:
+            self._first_id = question_id
+        if self._index is None and question_id != self._first_id + index:  # The ids aren't dense anymore
+            self._index = {known_id: known_index for known_index, known_id in enumerate(self.question_ids)}
+        if self._index is not None:
+            if question_id in self._index:
+                raise ValueError("Question " + str(question_id) + " is in the bank twice")
+            self._index[question_id] = index
+        position = chatlib.MSG_HEADER_LENGTH
+        for field in [str(question_id), info["question"]] + list(info["answers"][:3]):
+            position += len(field.encode()) + 1  # The field and its "#"
+            self._fields.append(position)
+        text += full_msg.encode()
+        self._offsets.append(len(text))
+        self.question_ids.append(question_id)
+        correct.append(answer)
+
+    def __len__(self):
+        return len(self.question_ids)
+
+    def __contains__(self, question_id):
+        return self.index_of(question_id) is not None
+
+    def __iter__(self):
+        return iter(self.question_ids)
+
+    def index_of(self, question_id):
+        """
+        return: the question's index in the bank, or None if there is no such question. O(1)
+        :rtype: int, or None
+        """
+        if self._index is not None:
+            return self._index.get(question_id)
+        if not isinstance(question_id, int) or self._first_id is None:
+            return None
+        index = question_id - self._first_id
+        return index if 0 <= index < len(self.question_ids) else None
+
+    def frame(self, index):
+        """
+        return: the encoded YOUR_QUESTION message of the question, a view of the string table - nothing is copied
+        :rtype: memoryview
+        """
+        return self._view[self._offsets[index]:self._offsets[index + 1]]
+
+    def correct(self, index):
+        """
+        return: the number of the correct answer, 1-4
+        :rtype: int
+        """
+        return self._correct[index]
+
+    def is_correct(self, index, choice):
+        """
+        Checks an answer without building any object
+        :param choice: the answer's number as the client sent it
+        :type choice: str
+        :rtype: bool
+        """
+        return len(choice) == 1 and ord(choice) - 48 == self._correct[index]
+
+    def question(self, index):
+        """
+        return: the question's text, answers and correct answer - decoded from the string table, for the cache
+        :rtype: dict
+        """
+        start = self._offsets[index]
+        bounds = [start + offset for offset in self._fields[index * 5:index * 5 + 5]] + [self._offsets[index + 1] + 1]
+        fields = [str(self._view[bounds[i]:bounds[i + 1] - 1], "utf-8") for i in range(5)]  # Without the "#"
+        return {"question": fields[0], "answers": tuple(fields[1:]), "correct": str(self._correct[index])}
+
+    def items(self):
+        """
+        return: generator of (question id, question) of every question, in the bank's order
+        """
+        return ((question_id, self.question(index)) for index, question_id in enumerate(self.question_ids))
+
+    def unseen_count(self, asked):
+        """
+        :param asked: the questions the user was asked
+        :type asked: user_store.QuestionBitset
+        return: how many questions of the bank the user wasn't asked - one popcount over the bank's id range when
+        the ids are dense, else of the asked ids and-ed with the bank's ids. No question is looked at
+        :rtype: int
+        """
+        if not len(asked) or not self.question_ids:
+            return len(self.question_ids)
+        if self._index is None:
+            return len(self.question_ids) - asked.count_range(self._first_id, self._first_id + len(self.question_ids))
+        return len(self.question_ids) - asked.count_common(self._id_bits)
+
+    def unseen_indices(self, asked):
+        """
+        :param asked: the questions the user was asked
+        :type asked: user_store.QuestionBitset
+        return: the indices of the questions the user wasn't asked - a byte at a time when the ids are dense,
+        else every id is checked
+        :rtype: array.array
+        """
+        if not len(asked) or not self.question_ids:
+            return array("I", range(len(self.question_ids)))
+        if self._index is None:  # Index i is id _first_id + i, so the missing ids are the indices
+            return asked.missing(self._first_id, self._first_id + len(self.question_ids))
+        return array("I", (index for index, question_id in enumerate(self.question_ids) if question_id not in asked))
+
+    def extended(self, added):
+        """
+        Builds the next version with the added questions after the old ones. The old questions keep their indices,
+        so the decks of the old version just get the new indices
+        :param added: dictionary of the new questions by their int ids, none of them is in the bank
+        :type added: dict
+        return: the new snapshot
+        :rtype: QuestionBank
+        """
+        return QuestionBank(added, base=self)
+
+
+class QuestionDeck:
+    """
+    The questions a user wasn't asked yet, as a compact array of indices into the bank's list of question ids.
+    A question is drawn by swapping a random cell with the last one and popping it - O(1),
+    no copy of the bank and no retries however few questions are left.
+    """
+
+    def __init__(self, remaining=None):
+        """
+        :param remaining: indices of the questions the user wasn't asked yet, by QuestionBank.unseen_indices -
+        the deck takes it over. None for an empty deck
+        :type remaining: array.array
+        """
+        self._remaining = remaining if remaining is not None else array("I")
+
+    def __len__(self):
+        return len(self._remaining)
+
+    def extend(self, start, stop):
+        """
+        Adds the questions of indices start..stop-1, which were added to the bank
+        """
+        self._remaining.extend(range(start, stop))
+
+    def draw(self):
+        """
+        Takes a random question out of the deck
+        return: the question's index in the bank's list of question ids, or None if the deck is empty
+        :rtype: int, or None
+        """
+        remaining = self._remaining
+        if not remaining:
+            return None
+        position = random.randrange(len(remaining))
+        last = remaining.pop()
+        if position == len(remaining):  # The last cell was drawn
+            return last
+        drawn = remaining[position]
+        remaining[position] = last
+        return drawn
+
+
+# Questions file #
+
+def parse_question_record(line):
+    """
+    Parses the "question, answer1, answer2, answer3, answer4, correct" line of a question.
+    The fields are taken from the right, so a comma inside the question text doesn't break it
+    return: the question, or None if the line is broken
+    :rtype: dict, or None
+    """
+    fields = line.rsplit(",", 5)
+    if len(fields) != 6:
+        return None
+    correct = fields[5].strip()
+    if correct not in ("1", "2", "3", "4"):
+        return None
+    answers = tuple(sys.intern(answer.strip()) for answer in fields[1:5])  # Short answers repeat a lot in a big bank
+    return {"question": fields[0].strip(), "answers": answers, "correct": sys.intern(correct)}
+
+
+def load_questions_file(path):
+    """
+    Streams the questions file: an id line followed by its question line. Blank lines are skipped,
+    so the file doesn't have to keep an exact two-lines-per-question layout
+    :param path: the questions file
+    :type path: str
+    return: questions dictionary by int ids
+    :rtype: dict
+    """
+    questions = {}
+    question_id = None
+    with open(path, "r", encoding="utf-8") as questions_file:
+        for line in questions_file:
+            line = line.strip()
+            if line == "":
+                continue
+            if question_id is None:
+                question_id = int(line) if line.isascii() and line.isdigit() else line
+                continue
+            info = parse_question_record(line)
+            if info is not None and isinstance(question_id, int):  # A record with a broken id is skipped
+                questions[question_id] = info
+            question_id = None
+    return questions
+
+
+# Open Trivia Database prefetch #
+
+def parse_opentdb_results(results):
+    """
+    Turns the "results" list of an Open Trivia Database JSON response into questions
+    :param results: the questions of one response
+    :type results: list
+    return: list of dictionaries with the question, the answers and the correct answer, without ids
+    :rtype: list
+    """
+    parsed = []
+    for question in results:
+        # html.unescape used to decode any HTML entities to ensure that special characters, such as &amp;, &lt;, &gt;, etc., are converted back to their original characters.
+        question_text = html.unescape(question["question"])
+        correct_answer = html.unescape(question["correct_answer"])
+        answers = [correct_answer] + [html.unescape(ans) for ans in question["incorrect_answers"]]
+        random.shuffle(answers)  # Make the order random so the user won't remember the numer of correct ans from one game to another.
+        parsed.append({"question": question_text, "answers": answers, "correct": str(answers.index(correct_answer) + 1)})
+    return parsed
+
+
+def get_json(url, params):
+    """
+    return: the JSON response as a dictionary, or None if the request failed
+    :rtype: dict, or None
+    """
+    try:
+        response = requests.get(url, params=params, timeout=FETCH_TIMEOUT)
+        if response.status_code != 200:
+            return None
+        data = json.loads(response.content)
+    except (requests.RequestException, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def request_token(api_url):
+    """
+    Asks for a session token - the questions API doesn't return a question twice to the same token,
+    so the batches of a fetch don't repeat each other
+    return: the token, or None if the API didn't give one
+    :rtype: str, or None
+    """
+    data = get_json(api_url.rsplit("/", 1)[0] + "/api_token.php", {"command": "request"})
+    if data is None or data.get("response_code") != 0:
+        return None
+    return data.get("token")
+
+
+def fetch_batch(api_url, token=None, amount=BATCH_SIZE):
+    """
+    Requests one batch of multiple choice questions
+    return: the response_code (None if the request failed) and the questions without ids, empty unless the code is 0
+    :rtype: tuple
+    """
+    params = {"amount": amount, "type": "multiple"}
+    if token is not None:
+        params["token"] = token
+    data = get_json(api_url, params)
+    if data is None:
+        return None, []
+    if data.get("response_code") != 0:  # E.g. 5 - too many requests from this IP, 4 - the token ran out of questions
+        return data.get("response_code"), []
+    return 0, parse_opentdb_results(data["results"])
+
+
+def fetch_questions(api_url, batches, workers=FETCH_WORKERS):
+    """
+    Requests batches of questions in parallel. Open Trivia Database itself answers only one request of an IP every
+    RATE_LIMIT_DELAY seconds and refuses the rest with RATE_LIMITED, so against it most of the parallel batches are
+    asked again one at a time at that pace, for up to RATE_LIMIT_BUDGET seconds - the parallel requests only pay
+    off against a mirror without the limit
+    :param api_url: the questions API
+    :type api_url: str
+    :param batches: number of requests
+    :type batches: int
+    return: list of all the fetched questions without ids, may hold duplicates
+    :rtype: list
+    """
+    token = request_token(api_url)
+    fetched = []
+    limited = 0  # Batches refused by the rate limit
+    with ThreadPoolExecutor(max_workers=min(workers, max(batches, 1))) as executor:
+        for code, batch in executor.map(lambda batch_number: fetch_batch(api_url, token), range(batches)):
+            fetched += batch
+            if code == RATE_LIMITED:
+                limited += 1
+    delay = RATE_LIMIT_DELAY
+    waited = 0
+    while limited and waited + delay <= RATE_LIMIT_BUDGET:
+        time.sleep(delay)
+        waited += delay
+        code, batch = fetch_batch(api_url, token)
+        if code == RATE_LIMITED:  # Still too soon - wait twice as long
+            delay *= 2
+            continue
+        fetched += batch
+        limited -= 1
+        delay = RATE_LIMIT_DELAY
+    return fetched
+
+
+def question_key(info):
+    return info["question"].strip().lower()  # The same question may come back in another batch
+
+
+def new_questions(questions, fetched):
+    """
+    Picks the fetched questions the bank doesn't have yet and gives them ids after the biggest one
+    :param questions: the bank, a dictionary of int ids to questions or a QuestionBank
+    :type questions: dict, or QuestionBank
+    :param fetched: questions without ids
+    :type fetched: list
+    return: dictionary of the new questions by their new ids
+    :rtype: dict
+    """
+    known = {question_key(info) for question_id, info in questions.items()}
+    next_id = max(questions, default=0) + 1
+    added = {}
+    for info in fetched:
+        key = question_key(info)
+        if key in known:
+            continue
+        known.add(key)
+        added[next_id] = info
+        next_id += 1
+    return added
+
+
+def merge_questions(questions, fetched):
+    """
+    Adds the new questions to the bank, skipping questions it already has. Ids continue after the biggest one
+    :param questions: the bank, a dictionary of int ids to questions - updated in place
+    :type questions: dict
+    :param fetched: questions without ids
+    :type fetched: list
+    return: dictionary of the added questions by their new ids
+    :rtype: dict
+    """
+    added = new_questions(questions, fetched)
+    questions.update(added)
+    return added
+
+
+def load_cache(path):
+    """
+    return: the questions dictionary saved in the cache file, empty if there is no cache yet
+    :rtype: dict
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as cache_file:
+            saved = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return {item["id"]: {"question": item["question"], "answers": item["answers"], "correct": item["correct"]}
+            for item in saved["questions"]}
+
+
+def save_cache(path, questions):
+    """
+    Writes the bank to a temporary file and renames it over the cache, so a crash never leaves half a cache
+    """
+    saved = {"questions": [{"id": question_id, "question": info["question"], "answers": info["answers"],
+                            "correct": info["correct"]} for question_id, info in questions.items()]}
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as cache_file:
+        json.dump(saved, cache_file)
+    os.replace(temp_path, path)
+
+
+def top_up(base, api_url, cache_path, batches):
+    """
+    Fetches more questions, builds the next snapshot with them and saves it to the cache.
+    Blocking - the server runs it on its executor
+    :param base: the server's snapshot when the top up started - immutable, so it's safe to read on any thread
+    :type base: QuestionBank
+    :param batches: batches to request
+    :type batches: int
+    return: the snapshot extended with the new questions, or None if there are none
+    :rtype: QuestionBank, or None
+    """
+    added = new_questions(base, fetch_questions(api_url, batches))
+    if not added:
+        return None
+    bank = base.extended(added)
+    save_cache(cache_path, bank)
+    return bank
@@ -0,0 +1,62 @@
+##############################################################################
+# ratelimit.py
+##############################################################################
+import time
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, and bursts of up to burst requests.
+    The tokens are refilled lazily when a request comes, so an idle bucket costs nothing
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate  # Tokens added per second
+        self.burst = burst  # Max tokens
+        self.tokens = burst  # A new client may start with a burst
+        self.updated = now
+
+    def take(self, now):
+        """
+        Takes one token if there is one
+        :param now: time.monotonic() of the request
+        :type now: float
+        return: 0 if the request is allowed, else the seconds until a token is available
+        :rtype: float
+        """
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        self.tokens = tokens
+        return (1 - tokens) / self.rate
+
+
+class ClientLimits:
+    """
+    The token buckets of one connection, one per rate class, created on the class's first request
+    """
+    __slots__ = ("limits", "buckets")
+
+    def __init__(self, limits):
+        """
+        :param limits: a dictionary of rate classes to (rate, burst). Classes that aren't in it are unlimited
+        :type limits: dict
+        """
+        self.limits = limits
+        self.buckets = {}  # A dictionary of rate classes to their TokenBucket
+
+    def check(self, rate_class, now=None):
+        """
+        return: 0 if a request of the class is allowed now, else the seconds the client should wait
+        :rtype: float
+        """
+        bucket = self.buckets.get(rate_class)
+        if bucket is None:
+            limit = self.limits.get(rate_class)
+            if limit is None:
+                return 0
+            bucket = self.buckets[rate_class] = TokenBucket(limit[0], limit[1], time.monotonic())
+        return bucket.take(time.monotonic() if now is None else now)
@@ -0,0 +1,174 @@
+##############################################################################
+# rooms.py
+##############################################################################
+# Multiplayer rooms: every round all the players of a room get the same question, the first correct answer wins
+# the round. Questions and results are pushed to the players as ROOM_QUESTION and ROUND_OVER messages.
+import random
+import chatlib
+
+MIN_PLAYERS = 2  # Rounds run only while the room has this many players
+ROUND_TIME = 20  # Seconds to answer a round's question
+ROUND_GAP = 5  # Seconds between rounds, and from the second player's join to the first round
+WINNER_POINTS = 5
+
+
+class Broadcast:
+    """
+    One message pushed to many clients. It is encoded once per format, and the same bytes are queued to every client
+    """
+    __slots__ = ("text", "_binary")
+
+    def __init__(self, text):
+        """
+        :param text: the encoded text message
+        :type text: bytes
+        """
+        self.text = text
+        self._binary = None
+
+    def encoded(self, binary):
+        if not binary:
+            return self.text
+        if self._binary is None:
+            self._binary = chatlib.text_to_binary(self.text)
+        return self._binary
+
+
+class Room:
+    __slots__ = ("name", "members", "question_id", "question_index", "bank", "answers", "winner", "timer")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # A dictionary of usernames to their connection
+        self.question_id = None  # The question of the running round, None between rounds
+        self.question_index = None  # Its index in the bank
+        self.bank = None  # The question_bank.QuestionBank the round's question is from
+        self.answers = {}  # A dictionary of usernames to their answer in the running round
+        self.winner = None
+        self.timer = None  # Ends the running round, or starts the next one
+
+
+class RoomManager:
+    """
+    The rooms of one server process. Runs on the serving thread - the rounds are driven by the state's timers,
+    and the results of a round are recorded together when it ends.
+    """
+
+    def __init__(self, state):
+        """
+        :param state: the server's game data - its question bank, timers, push and record_answers are used
+        :type state: server_skeleton.ServerState
+        """
+        self.state = state
+        self.rooms = {}  # A dictionary of room names to their Room
+        self.member_rooms = {}  # A dictionary of usernames to the Room they are in
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def join(self, username, conn, name):
+        """
+        Moves the user to the room, the room is created if needed
+        return: the number of players in the room
+        :rtype: int
+        """
+        self.leave(username)
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name)
+        room.members[username] = conn
+        self.member_rooms[username] = room
+        if room.timer is None and len(room.members) >= MIN_PLAYERS:
+            room.timer = self.state.timers.call_later(ROUND_GAP, lambda: self.start_round(room))
+        return len(room.members)
+
+    def leave(self, username):
+        """
+        return: True if the user was in a room
+        :rtype: bool
+        """
+        room = self.member_rooms.pop(username, None)
+        if room is None:
+            return False
+        del room.members[username]
+        if not room.members:  # The answers of a running round are dropped with the room
+            if room.timer is not None:
+                self.state.timers.cancel(room.timer)
+            del self.rooms[room.name]
+        return True
+
+    def broadcast(self, room, message):
+        """
+        Pushes the message to every player of the room
+        :param message: the encoded text message
+        :type message: bytes
+        """
+        push = self.state.push
+        if push is None:  # The server can't push messages
+            return
+        broadcast = Broadcast(message)
+        for conn in room.members.values():
+            push(conn, broadcast)
+        self.state.metrics.count("pushed_messages", len(room.members))
+
+    def start_round(self, room):
+        room.timer = None
+        bank = self.state.bank
+        if len(room.members) < MIN_PLAYERS or not len(bank) or room.name not in self.rooms:
+            return  # Started again by the next join
+        index = random.randrange(len(bank))
+        room.question_id = bank.question_ids[index]
+        room.question_index = index
+        room.bank = bank
+        room.answers = {}
+        room.winner = None
+        frame = bank.frame(index)  # The YOUR_QUESTION message, pushed with the room's command
+        self.broadcast(room, b"ROOM_QUESTION".ljust(chatlib.CMD_FIELD_LENGTH) + frame[chatlib.CMD_FIELD_LENGTH:])
+        room.timer = self.state.timers.call_later(ROUND_TIME, lambda: self.end_round(room))
+
+    def in_round(self, username):
+        """
+        return: True if the user is in a room whose round is running
+        :rtype: bool
+        """
+        room = self.member_rooms.get(username)
+        return room is not None and room.question_id is not None
+
+    def answer(self, username, question_id, choice):
+        """
+        Takes a player's answer to the question of the room's running round
+        return: the reply to the player, or None if it isn't an answer to the room's question
+        :rtype: tuple, or None
+        """
+        room = self.member_rooms.get(username)
+        if room is None or room.question_id is None or room.question_id != question_id:
+            return None
+        if username in room.answers:
+            return "ERROR", "You already answered this round."
+        room.answers[username] = choice
+        if room.bank.is_correct(room.question_index, choice) and room.winner is None:
+            room.winner = username
+            self.end_round(room)
+            return "CORRECT_ANSWER", ""
+        if len(room.answers) == len(room.members):  # Everyone answered, no need to wait
+            self.end_round(room)
+        return "WRONG_ANSWER", ""  # The correct answer is sent to everyone when the round is over
+
+    def end_round(self, room):
+        """
+        Records the scores of all the answers of the round at once, pushes the result and schedules the next round
+        """
+        if room.timer is not None:
+            self.state.timers.cancel(room.timer)
+        question_id = room.question_id
+        results = [(username, question_id, WINNER_POINTS if username == room.winner else 0)
+                   for username in room.answers]
+        if results:
+            self.state.record_answers(results)
+        correct = room.bank.correct(room.question_index)
+        self.broadcast(room, chatlib.build_message("ROUND_OVER", chatlib.join_data([room.winner or "", correct]))
+                       .encode())
+        room.question_id = None
+        room.bank = None
+        room.answers = {}
+        room.timer = self.state.timers.call_later(ROUND_GAP, lambda: self.start_round(room))
@@ -1,443 +1,1145 @@
 ##############################################################################
 # server.py
 ##############################################################################
-import select
+import os
+import signal
 import socket
+import selectors
+import functools
+import logging
+import time
+from collections import deque
 import chatlib
-import random
-import requests
-import json
+import sessions
+import leaderboard
+import question_bank
+import persistence
+import user_store
+import event_loop as events
+import metrics
+import ratelimit
+import rooms
 import xml.etree.ElementTree
-import html
 
 # GLOBALS
-users = {}
-logged_users = {}  # a dictionary of client hostnames to usernames - will be used later
-questions = {}
 old_questions = {}
-messages_to_send = []  # List of tuples with the socket of the addressee and the msg.
+outgoing = {}  # A dictionary of client sockets to their OutboundBuffer, only while they have unsent data
+framers = {}  # A dictionary of client sockets to their chatlib.MessageFramer
+backlogged = set()  # Client sockets with framed requests left over from their last turn
+last_seen = {}  # A dictionary of client sockets to time.monotonic() of their last received bytes
+idle_timers = {}  # A dictionary of client sockets to the Timer that checks if they went idle
+event_loop = None  # The events.EventLoop serving all the sockets, created in main
+log = logging.getLogger("trivia.server")
 
 ERROR_MSG = "Error! "
 SERVER_PORT = 5678
 SERVER_IP = "127.0.0.1"
+HIGHSCORE_COUNT = 5  # Users in the HIGHSCORE reply
+RECV_BUFFER_SIZE = 4096  # Bytes read per recv, messages longer than that are put together by the framer
+PAUSE_READING_BYTES = 64 * 1024  # Stop reading requests of a client while this many reply bytes wait for it
+MAX_PENDING_BYTES = 1024 * 1024  # A client that lets this many reply bytes pile up is disconnected
+MESSAGES_PER_TURN = 32  # Requests served per client per loop turn, the rest wait until the other clients had theirs
+RATE_LIMITS = {  # A dictionary of rate classes to (requests per second, burst) per connection, see COMMAND_HANDLERS
+    "login": (2, 5),
+    "game": (20, 40),
+    "read": (50, 100),
+    "batch": (5, 10),
+}
+IDLE_TIMEOUT = 5 * 60  # Seconds without a request before a client is disconnected
+ANSWER_TIMEOUT = 60  # Seconds a player has to answer a question
+CORRECT_POINTS = 5
+# Latency-weighted scoring: a correct answer gets CORRECT_POINTS plus up to CORRECT_POINTS more the faster it is
+LATENCY_SCORING = os.environ.get("TRIVIA_LATENCY_SCORING", "0") == "1"
+MAX_ROOM_NAME_LENGTH = 32
+LISTEN_BACKLOG = 1024  # Connections the kernel holds for us between two accept batches
+SELECTOR_CLASS = selectors.DefaultSelector  # Event loop backend - epoll on Linux
+PREFETCH_BATCHES = 20  # Batches of 50 questions requested when there is no cache yet, see fetch_questions
+TOP_UP_BATCHES = 2  # Batches requested by every background top up
+TOP_UP_INTERVAL = 10 * 60  # Seconds between background top ups, 0 to never top up
+RELOAD_CHECK_INTERVAL = 1  # Seconds between checks for a SIGHUP that asks to reload the questions
+DATA_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+USERS_FILE = os.path.join(DATA_DIRECTORY, "users.txt")  # "username, password, score" lines
+QUESTIONS_FILE = os.path.join(DATA_DIRECTORY, "questions.txt")  # Pairs of an id line and a "question, 4 answers, correct" line
+# The data the server writes lives next to the files it reads, whatever directory the server is started from
+QUESTIONS_CACHE_FILE = os.path.join(DATA_DIRECTORY, "questions_cache.json")  # Web questions for the next start
+USERS_SNAPSHOT_FILE = os.path.join(DATA_DIRECTORY, "users_snapshot.txt")  # The users as of the last start
+SCORE_LOG_FILE = os.path.join(DATA_DIRECTORY, "scores.log")  # Score changes since the snapshot, replayed on start
+LOG_LEVEL = os.environ.get("TRIVIA_LOG_LEVEL", "INFO")  # DEBUG logs every message - off by default, it's slow
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
 
 
-# HELPER DICT METHODS
+# SERVER STATE
 
-def get_key_by_value(dictionary, target_value):
+class ServerState:
     """
-    Gets dict and a value and return it's key.
+    The game data the message handlers work on. It is passed to the handlers instead of living in globals,
+    so the select server and the asyncio server (async_server.py) share the same handlers.
     """
-    for key, value in dictionary.items():
-        if value == target_value:
-            return key
-    return None  # Return None if the value is not found in the dictionary
+
+    def __init__(self, users, questions):
+        self.users = users  # A dictionary of usernames to their user_store.UserRecord
+        if not isinstance(questions, question_bank.QuestionBank):
+            questions = question_bank.QuestionBank(questions)
+        self.bank = questions  # The current question_bank.QuestionBank snapshot, replaced as a whole by set_bank
+        self.decks = {}  # A dictionary of logged in usernames to their question_bank.QuestionDeck, built on demand
+        self.score_log = None  # persistence.ScoreLog that saves the score changes, None to keep them in memory only
+        self.metrics = metrics.Metrics()  # Counters and latencies of this process, sent in the STATS reply
+        self.rate_limits = RATE_LIMITS  # Empty to turn rate limiting off, e.g. for benchmarks
+        self.client_limits = {}  # A dictionary of client sockets to their ratelimit.ClientLimits
+        self.timers = events.TimerWheel()  # Answer deadlines and idle timeouts, advanced by the server's loop
+        self.pending_questions = {}  # A dictionary of usernames to their sessions.OutstandingQuestion
+        self.latency_scoring = LATENCY_SCORING
+        self.push = None  # Function that queues a rooms.Broadcast to a client, set by the server that can push
+        # Function that runs a blocking job off the serving thread and calls back on it with the job's future,
+        # set by the server's loop - offload(job, callback)
+        self.offload = None
+        # Function that returns the (name, value) gauges of the server's own sockets for STATS, set by the server
+        self.socket_gauges = None
+        self.rooms = rooms.RoomManager(self)  # Multiplayer rooms of the logged in users, by room name
+        self.logged_users = sessions.SessionRegistry()  # The logged in clients, looked up by socket or by username
+        # Users ordered by score, updated on every score change instead of sorting all the users per HIGHSCORE
+        self.leaderboard = leaderboard.Leaderboard(((username, user.score) for username, user in users.items()),
+                                                   HIGHSCORE_COUNT)
+        self.highscore_cache = None  # (top_scores_version(), encoded ALL_SCORE message) of the last HIGHSCORE
+
+    def set_bank(self, bank, extends=False):
+        """
+        Swaps in a new question bank snapshot, built off the serving thread. Questions that were already asked
+        keep the snapshot they were asked from
+        :param bank: the new snapshot
+        :type bank: question_bank.QuestionBank
+        :param extends: True if the snapshot is the current one with questions added after it, by extended().
+        The decks then just get the new indices, else they are built again from questions_asked
+        :type extends: bool
+        Returns: None
+        """
+        start = len(self.bank)
+        self.bank = bank
+        if extends:
+            for deck in self.decks.values():
+                deck.extend(start, len(bank))
+        else:
+            self.decks = {}
+        self.metrics.count("question_bank_swaps")
+
+    # The handlers reach users and logged users only through these methods,
+    # so the sharded server (sharded_server.py) can keep them in a store shared by its worker processes.
+
+    def get_user(self, username):
+        """
+        return: the user's password, score and questions_asked, or None if there is no such user
+        :rtype: user_store.UserRecord, or None
+        """
+        return self.users.get(username)
+
+    def is_user_logged_in(self, username):
+        return self.logged_users.is_user_logged_in(username)
+
+    def claim_login(self, conn, username):
+        """
+        Logs the user in on the connection, unless the user is already logged in
+        return: True if logged in, False if the user is already logged in
+        :rtype: bool
+        """
+        if self.logged_users.is_user_logged_in(username):
+            return False
+        self.logged_users.login(conn, username)
+        return True
+
+    def release_login(self, conn):
+        """
+        return: the user that was logged in on the connection, or None
+        :rtype: str, or None
+        """
+        username = self.logged_users.logout(conn)
+        self.decks.pop(username, None)  # Built again from questions_asked if the user comes back
+        self.drop_pending_question(username)
+        self.rooms.leave(username)
+        return username
+
+    def logged_names(self):
+        return self.logged_users.logged_names()
+
+    def next_question_index(self, username):
+        """
+        Draws a question the user wasn't asked yet
+        return: the question's index in the current bank, or None if the user was asked all of them
+        """
+        deck = self.decks.get(username)
+        if deck is None:
+            asked = self.get_user(username).asked()
+            if self.bank.unseen_count(asked) == 0:  # A popcount decides NO_QUESTIONS without scanning the bank
+                deck = question_bank.QuestionDeck()
+            else:
+                deck = question_bank.QuestionDeck(self.bank.unseen_indices(asked))
+            self.decks[username] = deck
+        return deck.draw()
+
+    def ask_question(self, username, index):
+        """
+        Makes the question of the index in the current bank the one the user has to answer in ANSWER_TIMEOUT
+        seconds, instead of its last one
+        return: the question's id
+        :rtype: int
+        """
+        self.drop_pending_question(username)
+        question_id = self.bank.question_ids[index]
+        timer = self.timers.call_later(ANSWER_TIMEOUT, functools.partial(self.expire_question, username, question_id))
+        self.pending_questions[username] = sessions.OutstandingQuestion(question_id, index, self.bank,
+                                                                        time.monotonic(), timer)
+        return question_id
+
+    def take_pending_question(self, username):
+        """
+        Called when the user's question is answered
+        return: seconds since the question was asked - it isn't pending anymore
+        :rtype: float
+        """
+        question = self.pending_questions.pop(username)
+        self.timers.cancel(question.timer)
+        return time.monotonic() - question.issued_at
+
+    def drop_pending_question(self, username):
+        question = self.pending_questions.pop(username, None)
+        if question is not None:
+            self.timers.cancel(question.timer)
+
+    def expire_question(self, username, question_id):
+        question = self.pending_questions.get(username)
+        if question is not None and question.question_id == question_id:
+            del self.pending_questions[username]
+            self.metrics.count("answers_expired")
+
+    def answer_points(self, seconds):
+        """
+        :param seconds: the time the user took to answer correctly
+        :type seconds: float
+        return: the points of the answer - CORRECT_POINTS, or with latency_scoring up to twice as many
+        :rtype: int
+        """
+        if not self.latency_scoring:
+            return CORRECT_POINTS
+        return CORRECT_POINTS + int(CORRECT_POINTS * max(0.0, 1 - seconds / ANSWER_TIMEOUT))
+
+    def record_answer(self, username, question_id, points):
+        """
+        Marks the question as asked and adds the points to the user's score
+        """
+        user = self.users[username]
+        user.add_asked(question_id)
+        if points:
+            user.score += points
+            self.leaderboard.update(username, user.score)
+        if self.score_log is not None:
+            self.score_log.record(username, question_id, user.score)  # Written to the disk by the log's thread
+
+    def record_answers(self, results):
+        """
+        Records the answers of a whole room round at once
+        :param results: (username, question id, points) tuples
+        :type results: list
+        """
+        for username, question_id, points in results:
+            self.record_answer(username, question_id, points)
+
+    def top_scores(self, count):
+        """
+        return: list of (username, score) of the count highest scores
+        :rtype: list
+        """
+        return self.leaderboard.top(count)
+
+    def top_scores_version(self):
+        """
+        return: a number that changes whenever the first HIGHSCORE_COUNT places change
+        :rtype: int
+        """
+        return self.leaderboard.top_version
+
+    def rank_of(self, username):
+        """
+        return: the user's place in the leaderboard, 1 is the highest score
+        :rtype: int
+        """
+        return self.leaderboard.rank(username)
+
+    def check_rate(self, conn, rate_class):
+        """
+        Takes a token of the client's bucket of the rate class
+        return: 0 if the request is allowed, else the seconds the client should wait
+        :rtype: float
+        """
+        limits = self.client_limits.get(conn)
+        if limits is None:
+            if not self.rate_limits:
+                return 0
+            limits = self.client_limits[conn] = ratelimit.ClientLimits(self.rate_limits)
+        return limits.check(rate_class)
+
+    def forget_client(self, conn):
+        self.client_limits.pop(conn, None)
+
+    def gauges(self):
+        """
+        return: (name, value) pairs of the server's current load, for the STATS reply
+        :rtype: list
+        """
+        gauges = [("logged_in", len(self.logged_users)), ("timers", len(self.timers)), ("rooms", len(self.rooms))]
+        if self.socket_gauges is not None:
+            gauges += self.socket_gauges()
+        return gauges
+
+
+def socket_gauges():
+    """
+    return: the select server's backlogged clients and its queued replies
+    :rtype: list
+    """
+    return [("backlogged_sockets", len(backlogged)), ("outbound_sockets", len(outgoing)),
+            ("outbound_bytes", sum(buffer.pending for buffer in outgoing.values()))]
 
 
 # HELPER SOCKET METHODS
 
-def build_and_send_message(conn, code, msg):
+class OutboundBuffer:
     """
-    Builds a new message using chatlib, wanted code and message. Prints debug info, then sends it to the given socket.
-    :param conn: an opened socket from the connect method.
+    Replies waiting to be sent to one client.
+    The client socket is non-blocking, so send() may take only part of a reply - the rest stays for the next turn.
+    """
+
+    def __init__(self):
+        self._chunks = deque()  # memoryviews of the encoded replies, sliced without copying after a short send
+        self.pending = 0  # Total unsent bytes
+
+    def append(self, data):
+        """
+        Queues encoded reply bytes
+        :param data: an encoded protocol message
+        :type data: bytes
+        Returns: None
+        """
+        self._chunks.append(memoryview(data))
+        self.pending += len(data)
+
+    def flush(self, conn):
+        """
+        Sends as much of the queued data as the socket accepts right now
+        :param conn: a non-blocking client socket
+        :type conn: socket
+        return: number of bytes still waiting
+        :rtype: int
+        """
+        while self._chunks:
+            chunk = self._chunks[0]
+            try:
+                sent = conn.send(chunk)
+            except (BlockingIOError, InterruptedError):  # The socket's send buffer is full
+                break
+            self.pending -= sent
+            if sent < len(chunk):  # Short write - keep the rest and wait until the socket is writable again
+                self._chunks[0] = chunk[sent:]
+                break
+            self._chunks.popleft()
+        return self.pending
+
+
+def encode_reply(reply, binary=False):
+    """
+    Handlers return a (code, msg) tuple, or a whole message already encoded to bytes when it is cached
+    :param reply: a handler's reply
+    :type reply: tuple, bytes, or memoryview of the question bank's string table
+    :param binary: True if the client chose the binary format. The cached messages are kept in the text format
+    :type binary: bool
+    return: the encoded protocol message
+    :rtype: bytes
+    """
+    if isinstance(reply, (bytes, memoryview)):
+        return chatlib.text_to_binary(reply) if binary else reply
+    message = chatlib.build_binary_message(*reply) if binary else chatlib.build_message(*reply)
+    if message is None:  # The data doesn't fit in the length field, e.g. LOGGED with thousands of users
+        return encode_reply(error_reply("The reply is too long."), binary)
+    return message if binary else message.encode()
+
+
+def send_encoded(conn, data):
+    """
+    Queues an encoded message on the client's own buffer, it is sent when the socket is writable
+    :param conn: a client socket
     :type conn: socket
-    :param code: the name of the chosen method
-    :type code: str
-    :param msg: full data
-    :type msg: str
+    :param data: an encoded protocol message
+    :type data: bytes
     Returns: Nothing
     """
-    global messages_to_send
-    full_msg = chatlib.build_message(code, msg)
-    # conn.send(full_msg.encode())  # Change the text to binary code
-    messages_to_send.append((conn, full_msg))  # Add msg and conn to list of massages
-    # print("The massage was sent successfully to client.")
-    print("[SERVER] ", full_msg)  # Debug print
+    global outgoing
+    if conn not in outgoing:
+        outgoing[conn] = OutboundBuffer()
+        if event_loop is not None:
+            event_loop.set_writer(conn, write_client)  # Watch for writability only while replies are pending
+    outgoing[conn].append(data)
 
 
-def recv_message_and_parse(conn):
+def push_message(conn, broadcast):
     """
-    Receives a new message from given socket, then parses the message using chatlib.
+    Queues a message the client didn't ask for, e.g. its room's question. Skipped for a client that doesn't read
+    what it was sent, the read that finds it over MAX_PENDING_BYTES disconnects it
+    :param conn: a client socket
+    :type conn: socket
+    :param broadcast: the message, encoded once for all of its clients
+    :type broadcast: rooms.Broadcast
+    """
+    buffer = outgoing.get(conn)
+    if buffer is not None and buffer.pending > MAX_PENDING_BYTES:
+        return
+    framer = framers.get(conn)
+    send_encoded(conn, broadcast.encoded(framer is not None and framer.binary))
+
+
+def recv_messages_and_parse(state, conn):
+    """
+    Receives new data from given socket, then frames and parses every complete message in it using chatlib.
+    :param state: the server's game data, its metrics count the received bytes
+    :type state: ServerState
     :param conn: an opened socket from the connect method.
     :type conn: socket
-    return: cmd (str) and data (str) of the received message. If error occurred, will return None, None
+    return: list of up to MESSAGES_PER_TURN cmd (str) and data (str) tuples, empty if no message is complete yet.
+    If the client closed the connection or sent a broken message, the last tuple is None, None
+    """
+    global framers
+    try:
+        msg_code = conn.recv(RECV_BUFFER_SIZE)  # Receive coded massage from the client.
+    except (BlockingIOError, InterruptedError):  # Nothing to read after all
+        return []
+    if msg_code == b"":  # An empty recv means the client closed the connection
+        return [(None, None)]
+    last_seen[conn] = time.monotonic()  # Checked by its idle timer
+    state.metrics.count("bytes_in", len(msg_code))
+    framer = framers.setdefault(conn, chatlib.MessageFramer())  # Keeps the leftovers of partial messages
+    framer.feed(msg_code)
+    return take_messages(conn)
+
+
+def take_messages(conn, limit=MESSAGES_PER_TURN):
+    """
+    Takes up to limit complete messages out of the client's framer, the rest stay there for its next turn
+    :param conn: a client socket
+    :type conn: socket
+    return: list of cmd (str) and data (str) tuples. If the client sent a broken message, the last tuple is None, None
     """
-    # Receive the data from the client - until 1024 bytes.
-    msg_code = conn.recv(1024)  # Receive coded massage from the client.
-    msg = msg_code.decode()  # Change the massage code to text by decode().
-    cmd, data = chatlib.parse_message(msg)  # Parses protocol message and returns command name and data field.
-    print("[CLIENT] ", msg)  # Debug print
-    return cmd, data
+    framer = framers[conn]
+    messages = []
+    while len(messages) < limit:  # One recv may hold several pipelined messages
+        message = framer.next_message()
+        if message is None:
+            break
+        messages.append(message)
+        if message == (None, None):  # Nothing can be framed after a broken header
+            break
+    if log.isEnabledFor(logging.DEBUG):  # Skips the loop altogether when debug logging is off
+        for cmd, data in messages:
+            log.debug("[CLIENT] %s %s", cmd, data)
+    return messages
 
 
 # Data Loaders #
 
 def load_questions():
     """
-    Loads questions bank from file	## FILE SUPPORT TO BE ADDED LATER
+    Loads questions bank from file, streamed record by record
     Receives: -
     Returns: questions dictionary
     """
-    global questions
-    questions_input_file = open(r"C:\trivia\fina_with_extensions\questions.txt", "r")
-    line_counter = 0
-    for line in questions_input_file:
-        if line_counter % 2 == 0:
-            line = line.replace("\n", "")
-            list_questions_details = line.split(",")
-            question_id = list_questions_details[0]
-        else:
-            line = line.replace(" \n", "")
-            list_questions_details = line.split(",")
-            for i in range(1, 6):
-                list_questions_details[i] = list_questions_details[i].replace(" ", "")
-            question = list_questions_details[0]
-            answers = [list_questions_details[1], list_questions_details[2], list_questions_details[3], list_questions_details[4]]
-            correct = list_questions_details[5]
-            questions[question_id] = {"question": question, "answers": answers, "correct": correct}
-        line_counter += 1
-    questions_input_file.close()
-    return questions
+    return question_bank.load_questions_file(QUESTIONS_FILE)
 
 
 def load_questions_from_web():
     """
-    Loads questions bank from web service called Open Trivia Database
+    Loads questions bank from the local cache file, or if there is no cache yet from web service called
+    Open Trivia Database - PREFETCH_BATCHES requests in parallel, merged without duplicates and saved to the cache
     Receives: -
     Returns: questions dictionary
     """
-    global questions
+    questions = question_bank.load_cache(QUESTIONS_CACHE_FILE)  # Starting from the cache doesn't wait for the network
+    if questions:
+        return questions
     # Because the XML format is causing difficulties, and the API supports alternative data formats, we would use JSON
-    api_url = "https://opentdb.com/api.php?amount=50&type=multiple"
-
-    # Send a GET request to the API
-    # Get method is used as part of the "requests" library to send a GET request to the specified URL.
-    response = requests.get(api_url)  # The response object contains info about the HTTP response, including the response content.
-
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        # Parse the JSON response
-        # response.content retrieves the raw content of the response as bytes
-        # json.loads() is a func provided by the json module in Python.It takes a str or bytes representing a JSON object and converts it into a Python object.
-        data = json.loads(response.content)
-
-        question_id = 0
-        answers = []
-        for question in data["results"]:
-            question_id += 1
-            # html.unescape used to decode any HTML entities to ensure that special characters, such as &amp;, &lt;, &gt;, etc., are converted back to their original characters.
-            question_text = html.unescape(question["question"])
-            correct_answer = html.unescape(question["correct_answer"])
-            incorrect_answers = [html.unescape(ans) for ans in question["incorrect_answers"]]
-
-            answers.append(correct_answer)
-            answers += incorrect_answers  # Add the right and incorrect ans to the answers field
-            random.shuffle(answers)  # Make the order random so the user won't remember the numer of correct ans from one game to another.
-            correct_answer_index = answers.index(correct_answer) + 1
-
-            questions[question_id] = {
-                "question": question_text,
-                "answers": answers,
-                "correct": str(correct_answer_index)
-            }
-
-            answers = []  #  Initializes the answer field for each new question
-            correct_answer_index = 0  #  Initializes the correct answer index field for each new question
-
+    question_bank.merge_questions(questions, question_bank.fetch_questions(question_bank.OPENTDB_URL, PREFETCH_BATCHES))
+    if questions:
+        question_bank.save_cache(QUESTIONS_CACHE_FILE, questions)
         return questions
-
     else:
-        print("Request failed with status code:", response.status_code)
+        log.warning("Request failed, no questions from the web.")
         return load_questions()  # If the web service doesn't work then use the based method of the game
 
 
+def start_questions_top_up(state):
+    """
+    Keeps adding questions from the web while the server runs, if TOP_UP_INTERVAL is set. Every TOP_UP_INTERVAL
+    seconds the fetch runs on the loop's executor, and the new questions are added back on the serving thread
+    :param state: the server's game data
+    :type state: ServerState
+    """
+    if not TOP_UP_INTERVAL:
+        return
+
+    def job(base):  # The next snapshot is built on the executor too
+        return base, question_bank.top_up(base, question_bank.OPENTDB_URL, QUESTIONS_CACHE_FILE, TOP_UP_BATCHES)
+
+    def top_up_done(future):
+        try:
+            base, bank = future.result()
+        except Exception as error:  # The next top up tries again
+            log.warning("Questions top up failed: %s", error)
+        else:
+            if bank is not None and state.bank is base:
+                state.set_bank(bank, extends=True)
+                log.info("Added %d questions from the web.", len(bank) - len(base))
+            elif bank is not None:  # They are in the cache, the next reload has them
+                log.info("The question bank was reloaded during the top up, its questions are dropped.")
+        schedule()
+
+    def schedule():
+        state.timers.call_later(TOP_UP_INTERVAL, lambda: state.offload(functools.partial(job, state.bank),
+                                                                       top_up_done))
+
+    schedule()
+
+
+def start_questions_reload(state):
+    """
+    Reloads the question bank when the server gets SIGHUP, e.g. after the cache or the questions file was replaced.
+    The new snapshot is built on the loop's executor and swapped in between two requests, the clients are served
+    meanwhile. There is no SIGHUP on Windows
+    :param state: the server's game data
+    :type state: ServerState
+    """
+    if not hasattr(signal, "SIGHUP"):
+        return
+    requested = []  # The signal handler only flags the reload, the loop's timer starts it
+
+    def reload_done(future):
+        try:
+            bank = future.result()
+        except Exception as error:
+            log.error("Reloading the questions failed, keeping version %d: %s", state.bank.version, error)
+        else:
+            state.set_bank(bank)
+            log.info("Question bank version %d loaded, %d questions.", bank.version, len(bank))
+        schedule()
+
+    def check():
+        if requested:
+            requested.clear()
+            state.offload(lambda: question_bank.QuestionBank(load_questions_from_web()), reload_done)
+        else:
+            schedule()
+
+    def schedule():
+        state.timers.call_later(RELOAD_CHECK_INTERVAL, check)
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: requested.append(signum))
+    schedule()
+
+
 def load_user_database():
     """
-    Loads users list from file	## FILE SUPPORT TO BE ADDED LATER
+    Loads users list from file, streamed line by line into compact user_store.UserRecord objects
     Receives: -
     Returns: user dictionary
     """
-    global users
-    users_input_file = open(r"C:\trivia\fina_with_extensions\users.txt", "r")
-    for line in users_input_file:
-        line = line.replace(" ", "")
-        line = line.replace("\n", "")
-        list_user_details = line.split(",")
-        username = list_user_details[0]
-        password = list_user_details[1]
-        score = list_user_details[2]
-        users[username] = {"password": password, "score": score, "questions_asked": []}
-    users_input_file.close()
-    return users
+    return user_store.load_users_file(USERS_FILE)
 
 
 # SOCKET CREATOR
 
-def setup_socket():
+def setup_socket(reuse_port=False):
     """
     Creates new listening socket and returns it
+    :param reuse_port: let other processes listen on the same port, the kernel spreads the new connections between them
+    :type reuse_port: bool
     return: the socket object
     """
-    print("Setting up server...")
+    log.info("Setting up server...")
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a socket object of the server and insert to it IP protocol (AF_INET), and then TCP protocol (SOCK_STREAM).
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Restart on the port without waiting for TIME_WAIT
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((SERVER_IP, SERVER_PORT))  # Bind the server socket to local IP and port number for listening to clients and also to who comes from outside to IP address
-    sock.listen()  # Listening to connections from clients
-    print("Listening for clients...")
+    sock.listen(LISTEN_BACKLOG)  # Listening to connections from clients
+    log.info("Listening for clients on %s:%d", SERVER_IP, SERVER_PORT)
     return sock
 
 
 # HELPER QUESTIONS METHODS
-def create_random_question(username):
-    """
-    :param username: the user's name
-    :type username: str
-    Returns str with a question
-    """
-    global questions
-    global users
-    answers = ""
-    if len(questions) != len(users[username]["questions_asked"]):
-        while True:
-            questions_id, info = random.choice(list(questions.items()))  # Change info to list
-            if questions_id not in users[username]["questions_asked"]:
-                break
-        for answer in info["answers"]:
-            answers = answers + answer + "#"
-        answers = answers[0:-1]  # Remove last #
-        return str(questions_id) + "#" + str(info["question"]) + "#" + answers  # Returns question id and answers as str separated by #
-    else:
-        return ""
+NO_QUESTIONS_MESSAGE = chatlib.build_message("NO_QUESTIONS", "").encode()
 
 
-def send_error(conn, error_msg):
+def error_reply(error_msg):
     """
-    Send error message with given message
-    :param conn: an opened socket from the connect method
-    :type conn: socket
+    Builds an error reply with given message
     :param error_msg: a message error string from called function
     :type error_msg: str
-    Returns: None
+    Returns: the reply code and message
+    :rtype: tuple
     """
-    build_and_send_message(conn, "ERROR", error_msg)
+    return "ERROR", error_msg
 
 
 # MESSAGE HANDLING
+# Every handler returns its reply as a (code, msg) tuple - the server that called it sends the reply.
 
-def handle_question_message(conn, username):
+def handle_question_message(state, username):
     """
-    :param conn: an opened socket
-    :type conn: socket
+    :param state: the server's game data
+    :type state: ServerState
     :param username: the user's name
     :type username: str
-    Gets sockets and sends random question to client
+    Returns a random question for the client - its encoded message is built when the bank is loaded
     """
-    question = create_random_question(username)
-    if question != "":
-        build_and_send_message(conn, "YOUR_QUESTION", str(question))
+    index = state.next_question_index(username)  # O(1) draw from the user's deck of unasked questions
+    if index is not None:
+        state.ask_question(username, index)  # Its answer is accepted until the deadline
+        return state.bank.frame(index)
     else:
-        build_and_send_message(conn, "NO_QUESTIONS", str(question))
+        return NO_QUESTIONS_MESSAGE
 
 
-def handle_getscore_message(conn, username):
+def handle_getscore_message(state, username):
     """
-    Sends user's score
-    :param conn: an opened socket
-    :type conn: socket
+    Returns user's score
+    :param state: the server's game data
+    :type state: ServerState
     :param username: the user name
     :type username: str
     """
-    global users
-    msg = users[username]["score"]
-    build_and_send_message(conn, "YOUR_SCORE", str(msg))
+    msg = state.get_user(username).score
+    return "YOUR_SCORE", str(msg)
 
 
-def handle_answer_message(conn, username, data):
+def handle_answer_message(state, username, data):
     """
-    Checks if the answer is correct (if it's ok than update score) and send fits msg
-    :param conn: an opened socket
-    :type conn: socket
+    Checks if the answer is correct (if it's ok than update score) and returns fits msg
+    :param state: the server's game data
+    :type state: ServerState
     :param username: the user's name
     :type username: str
     :param data: the user's answer
     :type data: str
     """
-    global users
-    global questions
-    idquestion_choice = chatlib.split_data(data, 1)
-    idquestion = int(idquestion_choice[0])
-    choice = idquestion_choice[1]
-    # answers = questions[idquestion]["answers"]
-    correct_ans = questions[idquestion]["correct"]
-    if str(correct_ans) == str(choice):
-        build_and_send_message(conn, "CORRECT_ANSWER", "")
-        users[username]["score"] = int(users[username]["score"]) + 5
+    question = state.pending_questions.get(username)
+    # The user's question - no parsing, no lookup. A running room round may have asked the same id, it comes first
+    if question is not None and question.is_answered_by(data) and not state.rooms.in_round(username):
+        choice = data[-1]
     else:
-        build_and_send_message(conn, "WRONG_ANSWER", str(correct_ans))
-    users[username]["questions_asked"].append(idquestion)
+        idquestion_choice = chatlib.split_data(data, 1)
+        id_text = idquestion_choice[0]
+        idquestion = int(id_text) if id_text.isascii() and id_text.isdigit() else None  # isdigit() alone takes "\xb2"
+        choice = idquestion_choice[1]
+        room_reply = state.rooms.answer(username, idquestion, choice)  # The question of the user's room round
+        if room_reply is not None:
+            return room_reply
+        if question is None or question.question_id != idquestion:  # Only the question the user was sent counts
+            if idquestion not in state.bank:
+                return error_reply("Unknown question.")
+            return error_reply("Time is up, or this question wasn't asked.")
+    seconds = state.take_pending_question(username)
+    bank = question.bank  # Checked against the bank it was asked from
+    if bank.is_correct(question.index, choice):
+        state.record_answer(username, question.question_id, state.answer_points(seconds))
+        return "CORRECT_ANSWER", ""
+    else:
+        state.record_answer(username, question.question_id, 0)
+        return "WRONG_ANSWER", str(bank.correct(question.index))
 
 
-def handle_highscore_message(conn):
+def handle_highscore_message(state):
     """
-    Sends the five most high scores of users
-    :param conn: an opened socket
-    :type conn: socket
+    Returns the five most high scores of users. The encoded reply is reused until the top five change
+    :param state: the server's game data
+    :type state: ServerState
     """
-    global users
-    msg = ""
-    sorted_users_by_scores = dict(sorted(users.items(), key=lambda x: int(x[1]["score"]), reverse=True))
-    counter = 0
-    for username in sorted_users_by_scores:
-        msg = msg + "\n" + username + ": " + str(users[username]["score"])
-        counter += 1
-        if counter == 5:
-            break
-    build_and_send_message(conn, "ALL_SCORE", msg)
+    version = state.top_scores_version()
+    if state.highscore_cache is None or state.highscore_cache[0] != version:
+        msg = ""
+        for username, score in state.top_scores(HIGHSCORE_COUNT):
+            msg = msg + "\n" + username + ": " + str(score)
+        state.highscore_cache = (version, chatlib.build_message("ALL_SCORE", msg).encode())
+    return state.highscore_cache[1]
 
 
-def handle_logged_message(conn):
+def handle_rank_message(state, username):
     """
-    Sends names of the logged users
-    :param conn: an opened socket
-    :type conn: socket
+    Returns user's place in the leaderboard
+    :param state: the server's game data
+    :type state: ServerState
+    :param username: the user name
+    :type username: str
+    """
+    return "YOUR_RANK", str(state.rank_of(username))
+
+
+def handle_logged_message(state):
+    """
+    Returns names of the logged users
+    :param state: the server's game data
+    :type state: ServerState
     """
-    global logged_users
-    msg = ""
-    for username in logged_users:
-        msg = msg + username + ", "
-    msg = msg[0:-2]  # Remove last comma
-    build_and_send_message(conn, "LOGGED_ANSWER", msg)
+    msg = state.logged_names()  # Names separated by ", ", kept by the registry between logins
+    return "LOGGED_ANSWER", msg
 
 
-def handle_logout_message(conn):
+def handle_logout_message(state, conn):
     """
-    Closes the given socket (in later chapters, also remove user from logged_users dictionary)
+    Removes the user of the given connection from the logged users. The server closes the connection itself
+    :param state: the server's game data
+    :type state: ServerState
     :param conn: an opened socket from the connect method
     :type conn: socket
-    Returns: None
+    Returns: the user's name, or None if the client wasn't logged in
     """
-    global logged_users
-    username = get_key_by_value(logged_users, conn)
-    del logged_users[username]
-    conn.close()  # Close the connection
-    print("Connection closed. Client " + username + " has logged out.")
+    return state.release_login(conn)
 
 
-def handle_login_message(conn, data):
+def handle_login_message(state, conn, data):
     """
     Gets socket and message data of login message. Checks  user and pass exists and match.
-    If not - sends error and finished. If all ok, sends OK message and adds user and address to logged_users
+    If not - returns error. If all ok, returns OK message and adds user and address to logged_users
+    :param state: the server's game data
+    :type state: ServerState
     :param conn: an opened socket from the connect method
     :type conn: socket
     :param data: a message data of login message
     :type data: str
-    Returns: None (sends answer to client)
+    Returns: the reply to the client
     """
-    global users  # This is needed to access the same users' dictionary from all functions
-    global logged_users  # To be used later
-
     user_and_pass = chatlib.split_data(data, 1)  # Split the msg of user#password to list
     user = user_and_pass[0]
-    password = user_and_pass[1]
-    if user in users:  # If user is registered in game and the password is correct
-        if user in logged_users:
-            send_error(conn, "Error! The user is already logged in!")
-        elif users[user]["password"] == password:  # If the user and the password are correct
-            build_and_send_message(conn, "LOGIN_OK", "")
-            logged_users[user] = conn  # Adding the user socket to logged_users dict
+    user_details = state.get_user(user) if user is not None else None
+    if user_details is not None:  # If user is registered in game and the password is correct
+        password = user_and_pass[1]
+        if state.is_user_logged_in(user):
+            return error_reply("Error! The user is already logged in!")
+        elif user_details.password == password:  # If the user and the password are correct
+            if not state.claim_login(conn, user):  # Adding the user socket to logged_users registry
+                return error_reply("Error! The user is already logged in!")  # Logged in elsewhere meanwhile
+            return "LOGIN_OK", ""
         else:
-            send_error(conn, "Error! Password does not match!")
+            return error_reply("Error! Password does not match!")
     else:
-        send_error(conn, "Error! Username does not exist")
+        return error_reply("Error! Username does not exist")
+
+
+def handle_join_room_message(state, conn, username, data):
+    """
+    Moves the user to the room with the given name, its rounds start once it has rooms.MIN_PLAYERS players
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: an opened socket, the room's questions are pushed to it
+    :type conn: socket
+    :param username: the user's name
+    :type username: str
+    :param data: the room's name
+    :type data: str
+    """
+    if not data or len(data) > MAX_ROOM_NAME_LENGTH:
+        return error_reply("Bad room name.")
+    if state.push is None:
+        return error_reply("This server has no rooms.")
+    players = state.rooms.join(username, conn, data)
+    return "ROOM_JOINED", chatlib.join_data([data, players])
+
+
+def handle_leave_room_message(state, username):
+    """
+    Takes the user out of its room
+    :param state: the server's game data
+    :type state: ServerState
+    :param username: the user's name
+    :type username: str
+    """
+    if not state.rooms.leave(username):
+        return error_reply("Not in a room.")
+    return "ROOM_LEFT", ""
+
+
+def handle_batch_message(state, conn, data):
+    """
+    Handles every request of a batch like a request of its own, and returns all the replies in one message.
+    A batch can't log out or hold another batch
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: an opened socket
+    :type conn: socket
+    :param data: the requests, whole text messages one after the other
+    :type data: str
+    Returns: the BATCH_ANSWER reply to the client
+    """
+    replies = []
+    for cmd, sub_data in chatlib.split_messages(data):
+        if cmd is None:
+            return error_reply("Broken batch.")
+        command = COMMAND_HANDLERS.get(cmd)
+        if command is not None and not command.in_batch:
+            reply = error_reply(cmd + " can't be sent in a batch.")
+        else:
+            reply = handle_client_message(state, conn, cmd, sub_data)
+        replies.append(encode_reply(reply))
+    msg = b"".join(replies).decode()
+    if len(msg.encode()) > chatlib.MAX_DATA_LENGTH:
+        return error_reply("The batch's replies are too long.")
+    return "BATCH_ANSWER", msg
+
+
+def handle_stats_message(state):
+    """
+    Returns the server's counters, load and per-command latencies as text lines
+    :param state: the server's game data
+    :type state: ServerState
+    """
+    return "STATS_ANSWER", state.metrics.report(state.gauges())
+
+
+# COMMAND DISPATCH
+
+AUTH_USER = "user"  # Only for logged in clients
+AUTH_GUEST = "guest"  # Only before logging in
+AUTH_ANY = "any"
+
+
+class Command:
+    """
+    How the server handles one client command. The checks run before the handler, so a request that fails them
+    is rejected without touching the game data
+    """
+    __slots__ = ("handler", "auth", "fields", "rate_class", "in_batch")
+
+    def __init__(self, handler, auth=AUTH_USER, fields=None, rate_class="read", in_batch=True):
+        """
+        :param handler: function that gets the state, the connection, the username (None for guests) and the data
+        :type handler: function
+        :param auth: AUTH_USER, AUTH_GUEST or AUTH_ANY
+        :type auth: str
+        :param fields: the number of "#" in the data, as chatlib.split_data expects it. None if the data isn't checked
+        :type fields: int, or None
+        :param rate_class: the group of commands that share a rate limit
+        :type rate_class: str
+        :param in_batch: False if the command can't be sent inside a BATCH
+        :type in_batch: bool
+        """
+        self.handler = handler
+        self.auth = auth
+        self.fields = fields
+        self.rate_class = rate_class
+        self.in_batch = in_batch
+
+
+def logout_command(state, conn):
+    handle_logout_message(state, conn)
+    return None  # Nothing is sent, the server closes the connection
+
 
+COMMAND_HANDLERS = {
+    "LOGIN": Command(lambda state, conn, user, data: handle_login_message(state, conn, data),
+                     auth=AUTH_GUEST, fields=1, rate_class="login"),
+    "LOGOUT": Command(lambda state, conn, user, data: logout_command(state, conn),
+                      auth=AUTH_ANY, rate_class="session", in_batch=False),
+    "MY_SCORE": Command(lambda state, conn, user, data: handle_getscore_message(state, user)),
+    "HIGHSCORE": Command(lambda state, conn, user, data: handle_highscore_message(state)),
+    "MY_RANK": Command(lambda state, conn, user, data: handle_rank_message(state, user)),
+    "LOGGED": Command(lambda state, conn, user, data: handle_logged_message(state)),
+    "GET_QUESTION": Command(lambda state, conn, user, data: handle_question_message(state, user), rate_class="game"),
+    "SEND_ANSWER": Command(lambda state, conn, user, data: handle_answer_message(state, user, data),
+                           fields=1, rate_class="game"),
+    "BATCH": Command(lambda state, conn, user, data: handle_batch_message(state, conn, data),
+                     auth=AUTH_ANY, rate_class="batch", in_batch=False),
+    "STATS": Command(lambda state, conn, user, data: handle_stats_message(state)),
+    "JOIN_ROOM": Command(lambda state, conn, user, data: handle_join_room_message(state, conn, user, data),
+                         fields=0, rate_class="game"),
+    "LEAVE_ROOM": Command(lambda state, conn, user, data: handle_leave_room_message(state, user), rate_class="game"),
+}  # A dictionary of command names to their Command - a new command only needs a line here
 
-def handle_client_message(conn, cmd, data):
+
+def handle_client_message(state, conn, cmd, data):
     """
-    Gets message code and data and calls the right function to handle command
+    Handles one request and records its count and handling time in the server's metrics
+    :param state: the server's game data
+    :type state: ServerState
     :param conn: an opened socket
     :type conn: socket
     :param cmd: message code
     :type cmd: str
     param data: data
     :type data: str
+    Returns: the (code, msg) reply or the encoded reply to send, or None if there is nothing to send
+    """
+    start = time.perf_counter()
+    reply = route_client_message(state, conn, cmd, data)
+    # Unknown commands are counted together, so a client can't fill the metrics with made up names
+    state.metrics.record_command(cmd if cmd in COMMAND_HANDLERS else "UNKNOWN", time.perf_counter() - start)
+    return reply
+
+
+def route_client_message(state, conn, cmd, data):
+    """
+    Finds the command in COMMAND_HANDLERS, checks the client may send it and its data has the right fields,
+    then calls its handler
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: an opened socket
+    :type conn: socket
+    :param cmd: message code
+    :type cmd: str
+    param data: data
+    :type data: str
+    Returns: the (code, msg) reply or the encoded reply to send, or None if there is nothing to send.
+    Every request but LOGOUT is answered, so pipelined replies stay in order
+    """
+    command = COMMAND_HANDLERS.get(cmd)
+    wait = state.check_rate(conn, command.rate_class if command is not None else "read")  # Before any other work
+    if wait:
+        state.metrics.count("throttled")
+        return "THROTTLED", str(int(wait * 1000) + 1)
+    if command is None:
+        return error_reply("Unknown command.")
+    username = state.logged_users.get_username(conn)  # None if the client isn't logged in
+    if command.auth == AUTH_USER and username is None:
+        return error_reply("Log in first.")
+    if command.auth == AUTH_GUEST and username is not None:
+        return error_reply("Already logged in.")
+    if command.fields is not None and data.count(chatlib.DATA_DELIMITER) != command.fields:
+        return error_reply("Malformed " + cmd + " request.")
+    return command.handler(state, conn, username, data)
+
+
+# SELECT SERVER
+
+def close_client(state, conn):
+    """
+    Logs the client out and closes its socket, dropping its unframed and unsent bytes
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: a client socket
+    :type conn: socket
     Returns: None
     """
-    global logged_users
-    username = ""
-    if conn not in logged_users.values() and cmd == "LOGIN":
-        handle_login_message(conn, data)
-    elif conn in logged_users.values():
-        username = get_key_by_value(logged_users, conn)
+    username = handle_logout_message(state, conn)  # None if the client disconnected before logging in
+    framers.pop(conn, None)  # Forget the unframed bytes of the closed connection
+    backlogged.discard(conn)  # And the requests it will never get an answer to
+    outgoing.pop(conn, None)  # And the replies it will never read
+    last_seen.pop(conn, None)
+    if conn in idle_timers:
+        state.timers.cancel(idle_timers.pop(conn))
+    state.forget_client(conn)
+    if event_loop is not None:
+        event_loop.remove(conn)
+    conn.close()  # Close the connection
+    state.metrics.count("connections_closed")
+    log.debug("Connection closed. Client %s has logged out.", username)
+
+
+def accept_client(state, client_socket, client_address):
+    """
+    Called by the event loop for every new connection
+    :param state: the server's game data
+    :type state: ServerState
+    :param client_socket: the socket of the new client
+    :type client_socket: socket
+    :param client_address: a tuple with the IP, port of the client
+    :type client_address: tuple
+    """
+    client_socket.setblocking(False)  # A slow client must never block the whole server on send
+    state.metrics.count("connections_accepted")
+    log.debug("New client joined! %s", client_address)
+    event_loop.add_reader(client_socket, functools.partial(read_client, state))
+    last_seen[client_socket] = time.monotonic()
+    idle_timers[client_socket] = state.timers.call_later(IDLE_TIMEOUT, functools.partial(reap_if_idle, state,
+                                                                                           client_socket))
+
+
+def reap_if_idle(state, conn):
+    """
+    Called by the timers IDLE_TIMEOUT seconds after the client's last check. Closes it if it sent nothing since,
+    else checks again IDLE_TIMEOUT seconds after its last request - one timer per client, not one per request
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: a client socket
+    :type conn: socket
+    """
+    idle = time.monotonic() - last_seen[conn]
+    if idle >= IDLE_TIMEOUT:
+        del idle_timers[conn]
+        log.debug("Client was idle for %d seconds, disconnecting.", idle)
+        state.metrics.count("idle_clients_reaped")
+        close_client(state, conn)
+    else:
+        idle_timers[conn] = state.timers.call_later(IDLE_TIMEOUT - idle, functools.partial(reap_if_idle, state,
+                                                                                            conn))
+
+
+def read_client(state, conn):
+    """
+    Called by the event loop when the client's socket is readable. Handles up to MESSAGES_PER_TURN requests in it
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: a client socket
+    :type conn: socket
+    """
+    # noinspection PyBroadException
+    try:
+        messages = recv_messages_and_parse(state, conn)
+        if not serve_messages(state, conn, messages):
+            return
+    except:  # Handle in clients which closed cmd without error: #
+        close_client(state, conn)
+        return
+    finish_turn(state, conn, len(messages))
+
+
+def serve_backlog(state, conn):
+    """
+    Called by the event loop on the turn after a client used up its MESSAGES_PER_TURN,
+    serves the next requests it already sent
+    :param state: the server's game data
+    :type state: ServerState
+    :param conn: a client socket
+    :type conn: socket
+    """
+    if conn not in backlogged:  # Closed meanwhile
+        return
+    # noinspection PyBroadException
+    try:
+        messages = take_messages(conn)
+        if not serve_messages(state, conn, messages):
+            return
+    except:  # Handle in clients which closed cmd without error: #
+        close_client(state, conn)
+        return
+    finish_turn(state, conn, len(messages))
+
+
+def serve_messages(state, conn, messages):
+    """
+    Handles the client's requests and queues the replies
+    return: False if the client's connection was closed
+    :rtype: bool
+    """
+    for cmd, data in messages:  # Serve every pipelined request
+        if cmd is None and data is None:
+            close_client(state, conn)
+            return False
+        reply = handle_client_message(state, conn, cmd, data)
         if cmd == "LOGOUT":
-            handle_logout_message(conn)
-        if cmd == "MY_SCORE":
-            handle_getscore_message(conn, username)
-        if cmd == "HIGHSCORE":
-            handle_highscore_message(conn)
-        if cmd == "LOGGED":
-            handle_logged_message(conn)
-        if cmd == "GET_QUESTION":
-            handle_question_message(conn, username)
-        if cmd == "SEND_ANSWER":
-            handle_answer_message(conn, username, data)
+            close_client(state, conn)
+            return False
+        if reply is not None:
+            encoded = encode_reply(reply, framers[conn].binary)  # Answered in the client's format
+            send_encoded(conn, encoded)
+            state.metrics.count("bytes_out", len(encoded))
+            log.debug("[SERVER] %s", reply)
+    return True
+
+
+def finish_turn(state, conn, served):
+    """
+    Applies back-pressure after serving a client: its reading stops while it has many unread replies,
+    or while requests it already sent wait for its next turn
+    :param served: number of requests served on this turn
+    :type served: int
+    """
+    pending = outgoing[conn].pending if conn in outgoing else 0
+    if pending > MAX_PENDING_BYTES:
+        log.warning("Client doesn't read its replies, disconnecting.")
+        state.metrics.count("slow_clients_dropped")
+        close_client(state, conn)
+        return
+    if served == MESSAGES_PER_TURN:  # There may be more - serve them after the other clients had their turn
+        backlogged.add(conn)
+        event_loop.pause_reading(conn)  # No point reading more before the framed requests are served
+        event_loop.call_soon(functools.partial(serve_backlog, state, conn))
+        return
+    backlogged.discard(conn)
+    if pending > PAUSE_READING_BYTES:
+        event_loop.pause_reading(conn)  # Back-pressure: read more after it drains its replies
     else:
-        send_error(conn, "Unknown command.")
+        event_loop.resume_reading(conn)
+
+
+def write_client(conn):
+    """
+    Called by the event loop when the client's socket is writable and it has pending replies
+    :param conn: a client socket
+    :type conn: socket
+    """
+    try:
+        pending = outgoing[conn].flush(conn)
+    except OSError:  # The client is gone, the next read will find it closed and log it out
+        outgoing.pop(conn, None)
+        event_loop.clear_writer(conn)
+        if conn not in backlogged:
+            event_loop.resume_reading(conn)
+        return
+    if pending == 0:
+        del outgoing[conn]
+        event_loop.clear_writer(conn)  # Leaves the writable set until it has a new reply
+    if pending <= PAUSE_READING_BYTES and conn not in backlogged:  # A backlogged client resumes after its backlog
+        event_loop.resume_reading(conn)
+
 
+def serve(state, server_socket):
+    """
+    Serves clients on the listening socket until the event loop is stopped
+    :param state: the server's game data
+    :type state: ServerState
+    :param server_socket: a listening socket
+    :type server_socket: socket
+    """
+    global event_loop
+    event_loop = events.EventLoop(SELECTOR_CLASS)
+    event_loop.turn_time = state.metrics.loop_turns
+    event_loop.timers = state.timers  # The loop advances the answer deadlines, idle timeouts and room rounds
+    state.push = push_message
+    state.offload = event_loop.run_in_executor  # Blocking jobs never stall the clients
+    state.socket_gauges = socket_gauges
+    event_loop.add_listener(server_socket, functools.partial(accept_client, state))  # New clients are accepted in batches
+    event_loop.run_forever()  # Getting information from the clients
 
-def print_client_sockets(client_sockets):
-    global logged_users
-    for user in logged_users.values():
-        print("\t", user.getpeername())  # The method bringS the ip + port of the current client, /t is for tab space
+
+def load_users():
+    """
+    Loads the users from the last snapshot and the score log. Users added to the users file since then are added,
+    and passwords changed there are taken
+    Returns: user dictionary
+    """
+    return persistence.restore_users(USERS_SNAPSHOT_FILE, SCORE_LOG_FILE, load_user_database)
+
+
+def create_server_state():
+    """
+    Initializes users and questions dictionaries using load functions, then starts saving scores and topping up questions
+    return: the server's game data
+    :rtype: ServerState
+    """
+    state = ServerState(load_users(), load_questions_from_web())
+    state.score_log = persistence.ScoreLog(SCORE_LOG_FILE)
+    start_questions_top_up(state)
+    start_questions_reload(state)
+    return state
+
+
+def setup_logging():
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
 
 def main():
-    # Initializes global users and questions dictionaries using load functions, will be used later
-    global users
-    global questions
-    global messages_to_send
-    users = load_user_database()
-    questions = load_questions_from_web()
+    setup_logging()
+    state = create_server_state()
 
-    print("Welcome to Trivia Server!")
+    log.info("Welcome to Trivia Server!")
 
     server_socket = setup_socket()
-    client_sockets = []  # Contains all the objects of the clients who connect to the server
-
-    # Getting information from the clients: #
-    while True:  # While true the server looks for new clients
-        ready_to_read, ready_to_write, in_error = select.select([server_socket] + client_sockets, client_sockets,
-                                                                [])  # Sending to the func list of clients on server and the socket of the server
-        for current_socket in ready_to_read:  # Scanning the clients list
-            if current_socket is server_socket:  # if the current belong to server then new client wants join
-                # The running of the code stops ("blocking") until client will be connected.
-                # Client_socket - contain the info that the server must have for the connections to client.
-                # Client_address - a tuple with the IP, port (also in client_socket)
-                (client_socket, client_address) = current_socket.accept()
-                print("New client joined!", client_address)
-                client_sockets.append(client_socket)
-            else:
-                # noinspection PyBroadException
-                try:
-                    print("New data from client")
-                    cmd, data = recv_message_and_parse(current_socket)
-                    if cmd is None and data is None:
-                        handle_logout_message(current_socket)
-                        client_sockets.remove(current_socket)
-                        break
-                    handle_client_message(current_socket, cmd, data)
-                    if cmd == "LOGOUT":
-                        client_sockets.remove(current_socket)
-                        break
-                except:  # Handle in clients which closed cmd without error: #
-                    handle_logout_message(current_socket)
-                    client_sockets.remove(current_socket)
-                    break
-
-            for message in messages_to_send:
-                current_socket, data = message
-                if current_socket in ready_to_write:  # If the client's socket is available, means it's in rtw, send it's msg
-                    current_socket.send(data.encode())
-                    messages_to_send.remove(message)
-        # If client's socket isn't available, it will be sent next time
+    try:
+        serve(state, server_socket)
+    finally:
+        state.score_log.close()  # Writes the score changes still queued, e.g. after Ctrl-C
 
 
 if __name__ == '__main__':
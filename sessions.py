@@ -0,0 +1,133 @@
+##############################################################################
+# sessions.py
+##############################################################################
+
+
+class Session:
+    """
+    The state the server keeps for one logged in connection
+    """
+
+    def __init__(self, conn, username):
+        self.conn = conn  # The client's socket
+        self.username = username
+
+
+class OutstandingQuestion:
+    """
+    The one question a logged in user was asked and didn't answer yet. Everything an answer is checked against
+    is prepared when the question is asked, so checking SEND_ANSWER allocates nothing
+    """
+    __slots__ = ("question_id", "index", "bank", "token", "issued_at", "timer")
+
+    def __init__(self, question_id, index, bank, issued_at, timer):
+        self.question_id = question_id
+        self.index = index  # The question's index in bank
+        self.bank = bank  # The question_bank.QuestionBank it was asked from, its answer is checked against it
+        self.token = str(question_id) + "#"  # What the data of an answer to it starts with
+        self.issued_at = issued_at  # time.monotonic() when it was sent, for the answer time
+        self.timer = timer  # Drops the question at its deadline
+
+    def is_answered_by(self, data):
+        """
+        :param data: the data of a SEND_ANSWER request
+        :type data: str
+        return: True if the data is this question's id and a one-character choice
+        :rtype: bool
+        """
+        return len(data) == len(self.token) + 1 and data.startswith(self.token)
+
+
+class SessionRegistry:
+    """
+    Two-way index of logged in connections and usernames.
+    Both directions are dictionaries, so every lookup is O(1) no matter how many users are logged in.
+    """
+
+    def __init__(self):
+        self._by_conn = {}  # A dictionary of client sockets to their Session
+        self._by_username = {}  # A dictionary of usernames to their Session
+        self._logged_names = None  # Cached "user1, user2" text of the LOGGED reply, None after a change
+
+    def __len__(self):
+        return len(self._by_conn)
+
+    def __contains__(self, conn):
+        return conn in self._by_conn
+
+    def login(self, conn, username):
+        """
+        Registers the connection as logged in with the given user
+        :param conn: an opened socket
+        :type conn: socket
+        :param username: the user's name
+        :type username: str
+        return: the new session
+        :rtype: Session
+        """
+        session = Session(conn, username)
+        self._by_conn[conn] = session
+        self._by_username[username] = session
+        self._logged_names = None
+        return session
+
+    def logout(self, conn):
+        """
+        Removes the session of the connection
+        :param conn: an opened socket
+        :type conn: socket
+        return: the user's name, or None if the connection wasn't logged in
+        :rtype: str, or None
+        """
+        session = self._by_conn.pop(conn, None)
+        if session is None:
+            return None
+        del self._by_username[session.username]
+        self._logged_names = None
+        return session.username
+
+    def get_session(self, conn):
+        """
+        return: the session of the connection, or None if it isn't logged in
+        :rtype: Session, or None
+        """
+        return self._by_conn.get(conn)
+
+    def get_username(self, conn):
+        """
+        return: the user logged in on the connection, or None if it isn't logged in
+        :rtype: str, or None
+        """
+        session = self._by_conn.get(conn)
+        if session is None:
+            return None
+        return session.username
+
+    def get_conn(self, username):
+        """
+        return: the socket the user is logged in on, or None if the user isn't logged in
+        :rtype: socket, or None
+        """
+        session = self._by_username.get(username)
+        if session is None:
+            return None
+        return session.conn
+
+    def is_user_logged_in(self, username):
+        return username in self._by_username
+
+    def logged_names(self):
+        """
+        return: names of the logged users separated by ", " - built again only after a login or logout
+        :rtype: str
+        """
+        if self._logged_names is None:
+            self._logged_names = ", ".join(self._by_username)
+        return self._logged_names
+
+    def connections(self):
+        """
+        return: the sockets of all the logged in clients
+        :rtype: list
+        """
+        return list(self._by_conn)
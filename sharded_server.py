@@ -0,0 +1,262 @@
+##############################################################################
+# sharded_server.py
+##############################################################################
+# Pre-fork mode: N worker processes run the select server on the same port (SO_REUSEPORT), so the kernel spreads
+# the clients over all the cores. Users, scores and the logged in users live in a coordinator process that all
+# the workers talk to, so LOGGED, HIGHSCORE and the already-logged-in check see every worker's clients.
+# SIGHUP to the main process is passed on to the workers, every worker reloads its own question bank.
+# Usage: python sharded_server.py [workers]
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import threading
+from multiprocessing.managers import BaseManager
+import server_skeleton
+import leaderboard
+import persistence
+import user_store
+
+_store = None  # The SharedStore, set only in the coordinator process
+log = logging.getLogger("trivia.sharded_server")
+
+
+class SharedStore:
+    """
+    Users, scores and logged in users of all the workers. Lives in the coordinator process -
+    the manager serves every worker connection on its own thread, so every method holds the lock.
+    """
+
+    def __init__(self, users):
+        self._users = users  # A dictionary of usernames to their user_store.UserRecord
+        self._logged = {}  # A dictionary of logged in usernames to the worker they are logged in on
+        self._leaderboard = leaderboard.Leaderboard(((username, user.score) for username, user in users.items()),
+                                                    server_skeleton.HIGHSCORE_COUNT)
+        self._lock = threading.Lock()
+        self.score_log = None  # persistence.ScoreLog of the coordinator
+
+    def get_user(self, username):
+        """
+        return: a copy of the user's details, or None if there is no such user
+        :rtype: user_store.UserRecord, or None
+        """
+        with self._lock:
+            user = self._users.get(username)
+            if user is None:
+                return None
+            return user_store.UserRecord(user.password, user.score, user.asked().copy())
+
+    def is_user_logged_in(self, username):
+        with self._lock:
+            return username in self._logged
+
+    def claim_login(self, username, worker):
+        """
+        Marks the user as logged in on the worker, unless it's logged in already on any worker
+        return: True if logged in, False if the user is already logged in
+        :rtype: bool
+        """
+        with self._lock:
+            if username in self._logged:
+                return False
+            self._logged[username] = worker
+            return True
+
+    def release_login(self, username):
+        with self._lock:
+            self._logged.pop(username, None)
+
+    def release_worker(self, worker):
+        """
+        Logs out all the users of a worker that died, so they can log in again on the other workers
+        """
+        with self._lock:
+            for username in [username for username, owner in self._logged.items() if owner == worker]:
+                del self._logged[username]
+
+    def logged_names(self):
+        with self._lock:
+            return ", ".join(self._logged)
+
+    def record_answer(self, username, question_id, points):
+        with self._lock:
+            self._record_answer(username, question_id, points)
+
+    def record_answers(self, results):
+        """
+        Records the answers of a whole room round under one lock, in one call of the worker
+        :param results: (username, question id, points) tuples
+        :type results: list
+        """
+        with self._lock:
+            for username, question_id, points in results:
+                self._record_answer(username, question_id, points)
+
+    def _record_answer(self, username, question_id, points):
+        user = self._users[username]
+        user.add_asked(question_id)
+        if points:
+            user.score += points
+            self._leaderboard.update(username, user.score)
+        if self.score_log is not None:
+            self.score_log.record(username, question_id, user.score)
+
+    def close(self):
+        """
+        Writes the score changes still queued. Called by the main process before it shuts the coordinator down
+        """
+        with self._lock:
+            if self.score_log is not None:
+                self.score_log.close()
+                self.score_log = None
+
+    def top_scores(self, count):
+        with self._lock:
+            return self._leaderboard.top(count)
+
+    def top_scores_version(self):
+        with self._lock:
+            return self._leaderboard.top_version
+
+    def rank_of(self, username):
+        with self._lock:
+            return self._leaderboard.rank(username)
+
+
+def init_store(users):
+    """
+    Runs in the coordinator process when it starts
+    """
+    global _store
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)  # A SIGHUP to the process group is for the workers
+    _store = SharedStore(users)
+    _store.score_log = persistence.ScoreLog(server_skeleton.SCORE_LOG_FILE)  # Only the coordinator writes scores
+
+
+def get_store():
+    return _store
+
+
+class StoreManager(BaseManager):
+    pass
+
+
+StoreManager.register("get_store", callable=get_store)
+
+
+class SharedServerState(server_skeleton.ServerState):
+    """
+    ServerState of a worker. The sockets of its own clients are kept locally,
+    everything that all the workers must agree on is asked from the coordinator.
+    Rooms are local too - only the players that connected to the same worker play together.
+    """
+
+    def __init__(self, store, questions, worker):
+        super().__init__({}, questions)
+        self.store = store  # Proxy of the coordinator's SharedStore
+        self.worker = worker  # This worker's number
+
+    def get_user(self, username):
+        return self.store.get_user(username)
+
+    def is_user_logged_in(self, username):
+        return self.store.is_user_logged_in(username)
+
+    def claim_login(self, conn, username):
+        if not self.store.claim_login(username, self.worker):
+            return False
+        self.logged_users.login(conn, username)
+        return True
+
+    def release_login(self, conn):
+        username = self.logged_users.logout(conn)
+        if username is not None:
+            self.store.release_login(username)
+            self.decks.pop(username, None)
+            self.drop_pending_question(username)
+            self.rooms.leave(username)
+        return username
+
+    def logged_names(self):
+        return self.store.logged_names()
+
+    def record_answer(self, username, question_id, points):
+        self.store.record_answer(username, question_id, points)
+
+    def record_answers(self, results):
+        self.store.record_answers(results)
+
+    def top_scores(self, count):
+        return self.store.top_scores(count)
+
+    def top_scores_version(self):
+        return self.store.top_scores_version()
+
+    def rank_of(self, username):
+        return self.store.rank_of(username)
+
+    def gauges(self):
+        return [("worker", self.worker)] + super().gauges()  # The STATS reply is of this worker only
+
+
+def run_worker(address, authkey, questions, worker):
+    """
+    Runs one select server on the shared port. Used as a multiprocessing target
+    :param address: the coordinator's address
+    :type address: tuple
+    :param authkey: the coordinator's authentication key
+    :type authkey: bytes
+    :param questions: the questions dictionary - read only, so every worker has its own copy
+    :type questions: dict
+    :param worker: this worker's number
+    :type worker: int
+    """
+    manager = StoreManager(address=address, authkey=authkey)
+    manager.connect()
+    state = SharedServerState(manager.get_store(), questions, worker)
+    server_skeleton.setup_logging()
+    log.info("Worker %d started, pid %d", worker, os.getpid())
+    server_skeleton.start_questions_reload(state)
+    server_skeleton.serve(state, server_skeleton.setup_socket(reuse_port=True))
+
+
+def main():
+    workers_count = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    server_skeleton.setup_logging()
+    users = server_skeleton.load_users()
+    questions = server_skeleton.load_questions_from_web()
+
+    log.info("Welcome to Trivia Server! (%d workers)", workers_count)
+    authkey = bytes(multiprocessing.current_process().authkey)  # Workers use it to connect to the coordinator
+    manager = StoreManager(authkey=authkey)
+    manager.start(init_store, (users,))  # The coordinator process
+    store = manager.get_store()
+
+    workers = {}  # A dictionary of worker processes' sentinels to (worker number, process)
+    for worker in range(workers_count):
+        process = multiprocessing.Process(target=run_worker, args=(manager.address, authkey, questions, worker))
+        process.start()
+        workers[process.sentinel] = (worker, process)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: [os.kill(process.pid, signum)
+                                                            for worker, process in list(workers.values())])
+    try:
+        while workers:
+            for sentinel in multiprocessing.connection.wait(list(workers)):
+                worker, process = workers.pop(sentinel)
+                log.warning("Worker %d exited with code %s", worker, process.exitcode)
+                store.release_worker(worker)  # Its clients are gone with it
+    finally:
+        for worker, process in workers.values():
+            process.terminate()
+        for worker, process in workers.values():
+            process.join()  # No worker records a score after the log is closed
+        store.close()
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+##############################################################################
+# test_question_bank.py
+##############################################################################
+# A local HTTP server stands in for Open Trivia Database, so fetching, merging and caching run without the network.
+# Usage: python -m unittest test_question_bank
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import question_bank
+
+
+def opentdb_question(text, correct, incorrect):
+    return {"type": "multiple", "question": text, "correct_answer": correct, "incorrect_answers": incorrect}
+
+
+LARGEST_PLANET = {"response_code": 0,
+                  "results": [opentdb_question("Largest planet?", "Jupiter", ["Mars", "Venus", "Earth"])]}
+RATE_LIMITED = {"response_code": 5, "results": []}
+# One response per request, in the order the requests arrive
+RESPONSES = [
+    {"response_code": 0, "results": [opentdb_question("How much is 2+2?", "4", ["1", "2", "3"]),
+                                     opentdb_question("Capital of France?", "Paris", ["Lyon", "Nice", "Lille"])]},
+    {"response_code": 0, "results": [opentdb_question("  capital of FRANCE?", "Paris", ["Rome", "Oslo", "Bern"]),
+                                     opentdb_question("Tom &amp; Jerry is a...", "Cartoon", ["Song", "Car", "Game"])]},
+    {"response_code": 1, "results": [opentdb_question("Failed batch question?", "Yes", ["No", "Maybe", "Never"])]},
+    LARGEST_PLANET,
+]
+TOKEN = "f4k3t0k3n"
+# The keys the fetched questions are deduplicated by - which of the two French capitals is kept depends on which
+# request was answered first
+FETCHED_KEYS = {"how much is 2+2?", "capital of france?", "tom & jerry is a...", "largest planet?"}
+REQUEST_DELAY = 0.2  # Seconds every response waits, so requests sent in parallel overlap
+
+
+class FakeOpentdb(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeOpentdbHandler)
+        self.responses = RESPONSES
+        self.lock = threading.Lock()
+        self.requests_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0  # The most requests that were handled at the same time
+        self.queries = []  # The paths of the question requests
+        self.request_times = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api.php" % self.server_address[1]
+
+
+class FakeOpentdbHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith("/api_token.php?command=request"):
+            self.send_json({"response_code": 0, "response_message": "Token Generated Successfully!", "token": TOKEN})
+            return
+        with server.lock:
+            response = server.responses[server.requests_count % len(server.responses)]
+            server.requests_count += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.queries.append(self.path)
+            server.request_times.append(time.perf_counter())
+        time.sleep(REQUEST_DELAY)
+        with server.lock:
+            server.in_flight -= 1
+        self.send_json(response)
+
+    def send_json(self, response):
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # Keeps the test output clean
+        pass
+
+
+class FetchQuestionsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeOpentdb()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.directory.name, "questions_cache.json")
+        self.rate_limit = question_bank.RATE_LIMIT_DELAY, question_bank.RATE_LIMIT_BUDGET
+        question_bank.RATE_LIMIT_DELAY, question_bank.RATE_LIMIT_BUDGET = 0.1, 0.35
+
+    def tearDown(self):
+        question_bank.RATE_LIMIT_DELAY, question_bank.RATE_LIMIT_BUDGET = self.rate_limit
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_batches_are_fetched_in_parallel(self):
+        start = time.perf_counter()
+        fetched = question_bank.fetch_questions(self.server.url, len(RESPONSES), workers=len(RESPONSES))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(self.server.requests_count, len(RESPONSES))
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLess(elapsed, REQUEST_DELAY * len(RESPONSES))
+        self.assertTrue(all("amount=50" in query and "type=multiple" in query and "token=" + TOKEN in query
+                            for query in self.server.queries))  # Every batch uses the session token
+        self.assertEqual(len(fetched), 5)  # The failed batch is skipped, the duplicate is still there
+
+    def test_failed_batch_is_skipped(self):
+        fetched = question_bank.fetch_questions(self.server.url, len(RESPONSES))
+        self.assertNotIn("Failed batch question?", {info["question"] for info in fetched})
+        self.assertEqual(self.server.requests_count, len(RESPONSES))  # Only the rate limit is asked again
+
+    def test_rate_limited_batch_is_asked_again_later(self):
+        self.server.responses = [RATE_LIMITED, LARGEST_PLANET]
+        fetched = question_bank.fetch_questions(self.server.url, 1)
+        self.assertEqual([info["question"] for info in fetched], ["Largest planet?"])
+        self.assertEqual(self.server.requests_count, 2)
+        self.assertGreaterEqual(self.server.request_times[1] - self.server.request_times[0],
+                                question_bank.RATE_LIMIT_DELAY)
+
+    def test_rate_limit_retries_stop_at_the_budget(self):
+        self.server.responses = [RATE_LIMITED]
+        fetched = question_bank.fetch_questions(self.server.url, 1)
+        self.assertEqual(fetched, [])
+        self.assertEqual(self.server.requests_count, 3)  # Waited 0.1 and 0.2 seconds, 0.4 more is over the budget
+
+    def test_parsed_questions(self):
+        fetched = question_bank.fetch_questions(self.server.url, len(RESPONSES))
+        for info in fetched:
+            self.assertEqual(len(info["answers"]), 4)
+            self.assertIn(info["correct"], ("1", "2", "3", "4"))
+        cartoon = next(info for info in fetched if info["question"] == "Tom & Jerry is a...")  # HTML unescaped
+        self.assertEqual(cartoon["answers"][int(cartoon["correct"]) - 1], "Cartoon")
+
+    def test_merge_dedups_and_numbers_after_the_biggest_id(self):
+        questions = {7: {"question": "Largest planet?", "answers": ("Jupiter", "Mars", "Venus", "Earth"),
+                         "correct": "1"}}
+        added = question_bank.merge_questions(questions, question_bank.fetch_questions(self.server.url,
+                                                                                      len(RESPONSES)))
+        self.assertEqual(sorted(added), [8, 9, 10])  # "Largest planet?" is known, the two French capitals are one
+        self.assertEqual({question_bank.question_key(info) for info in added.values()},
+                         FETCHED_KEYS - {"largest planet?"})
+        self.assertEqual(sorted(questions), [7, 8, 9, 10])
+
+    def test_top_up_cache_round_trip(self):
+        base = question_bank.QuestionBank()
+        bank = question_bank.top_up(base, self.server.url, self.cache_path, len(RESPONSES))
+        self.assertEqual({question_bank.question_key(info) for question_id, info in bank.items()}, FETCHED_KEYS)
+        self.assertEqual(list(bank), [1, 2, 3, 4])
+        cached = question_bank.load_cache(self.cache_path)
+        self.assertEqual(sorted(cached), list(bank))
+        for question_id, info in bank.items():
+            self.assertEqual(cached[question_id]["question"], info["question"])
+            self.assertEqual(tuple(cached[question_id]["answers"]), info["answers"])
+            self.assertEqual(cached[question_id]["correct"], info["correct"])
+        # Nothing new on the next top up - the snapshot stays
+        self.assertIsNone(question_bank.top_up(question_bank.QuestionBank(cached), self.server.url, self.cache_path,
+                                               len(RESPONSES)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+##############################################################################
+# user_store.py
+##############################################################################
+import sys
+from array import array
+
+_popcount = getattr(int, "bit_count", lambda value: bin(value).count("1"))  # int.bit_count is Python 3.10+
+
+
+class QuestionBitset:
+    """
+    The ids of the questions a user answered, one bit per id of the dense question id space - a user who answered
+    every one of 100,000 questions costs 12.5 KB instead of a list of 100,000 ints.
+    Testing and adding an id are O(1), and counting the ids of a range is one popcount instead of a scan
+    """
+    __slots__ = ("_bits", "_count")
+
+    def __init__(self, question_ids=()):
+        self._bits = bytearray()
+        self._count = 0
+        for question_id in question_ids:
+            self.add(question_id)
+
+    def __reduce__(self):  # Sent between processes as its bytes
+        return QuestionBitset.from_bytes, (self.to_bytes(),)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, question_id):
+        if not isinstance(question_id, int) or question_id < 0:
+            return False
+        byte_index = question_id >> 3
+        return byte_index < len(self._bits) and bool(self._bits[byte_index] >> (question_id & 7) & 1)
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self._bits):
+            while byte:
+                low_bit = byte & -byte
+                yield (byte_index << 3) + low_bit.bit_length() - 1
+                byte ^= low_bit
+
+    def add(self, question_id):
+        """
+        :param question_id: the question's id - an int from 0
+        :type question_id: int
+        return: True if the id wasn't in the set before
+        :rtype: bool
+        """
+        byte_index = question_id >> 3
+        bits = self._bits
+        if byte_index >= len(bits):
+            bits.extend(bytes(byte_index + 1 - len(bits)))
+        mask = 1 << (question_id & 7)
+        if bits[byte_index] & mask:
+            return False
+        bits[byte_index] |= mask
+        self._count += 1
+        return True
+
+    def copy(self):
+        bitset = QuestionBitset()
+        bitset._bits = bytearray(self._bits)
+        bitset._count = self._count
+        return bitset
+
+    def count_range(self, start, stop):
+        """
+        return: how many ids of start..stop-1 are in the set, counted on the bits of the range at once
+        :rtype: int
+        """
+        stop = min(stop, len(self._bits) << 3)
+        if start >= stop:
+            return 0
+        if start == 0 and stop == len(self._bits) << 3:
+            return self._count
+        chunk = int.from_bytes(self._bits[start >> 3:((stop - 1) >> 3) + 1], "little") >> (start & 7)
+        return _popcount(chunk & ((1 << (stop - start)) - 1))
+
+    def count_common(self, other):
+        """
+        return: how many ids are in both sets, one popcount of the two bitsets and-ed
+        :rtype: int
+        """
+        return _popcount(int.from_bytes(self._bits, "little") & int.from_bytes(other._bits, "little"))
+
+    def missing(self, start, stop):
+        """
+        The ids of start..stop-1 that aren't in the set, as offsets from start - bytes with all their bits set
+        or none of them are skipped or taken whole
+        return: array of the offsets
+        :rtype: array.array
+        """
+        offsets = array("I")
+        bits = self._bits
+        known_stop = min(stop, len(bits) << 3)  # The ids after the last byte aren't in the set
+        question_id = start
+        while question_id < known_stop:
+            byte = bits[question_id >> 3]
+            if question_id & 7 == 0 and question_id + 8 <= known_stop and byte in (0, 0xFF):
+                if byte == 0:
+                    offsets.extend(range(question_id - start, question_id - start + 8))
+                question_id += 8
+                continue
+            if not byte >> (question_id & 7) & 1:
+                offsets.append(question_id - start)
+            question_id += 1
+        if question_id < stop:
+            offsets.extend(range(question_id - start, stop - start))
+        return offsets
+
+    def to_bytes(self):
+        """
+        return: the bits, bit i of byte j is the id j*8+i. Trailing zero bytes are dropped
+        :rtype: bytes
+        """
+        return bytes(self._bits).rstrip(b"\x00")
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: bytes saved by to_bytes
+        :type data: bytes
+        """
+        bitset = cls()
+        bitset._bits = bytearray(data)
+        bitset._count = _popcount(int.from_bytes(data, "little"))
+        return bitset
+
+
+_NOTHING_ASKED = QuestionBitset()  # asked() of every user before the first answer - never added to
+
+
+class UserRecord:
+    """
+    One user of the game. __slots__ and an int score keep it at a fraction of the dictionary it replaces,
+    and questions_asked stays None until the user's first answer - most users of a big file never play
+    """
+    __slots__ = ("password", "score", "questions_asked")
+
+    def __init__(self, password, score=0, questions_asked=None):
+        self.password = password
+        self.score = score  # int
+        self.questions_asked = questions_asked  # QuestionBitset of the answered question ids, None before the first
+
+    def __reduce__(self):  # Lets the sharded server send records between processes
+        return UserRecord, (self.password, self.score, self.questions_asked)
+
+    def add_asked(self, question_id):
+        if self.questions_asked is None:
+            self.questions_asked = QuestionBitset()
+        self.questions_asked.add(question_id)
+
+    def asked(self):
+        """
+        return: the ids of the questions the user answered - read only
+        :rtype: QuestionBitset
+        """
+        return self.questions_asked if self.questions_asked is not None else _NOTHING_ASKED
+
+
+def parse_user_line(line):
+    """
+    Parses a "username, password, score" line of the users file
+    return: username and its UserRecord, or None, None if the line is empty or broken
+    :rtype: tuple
+    """
+    fields = line.split(",")
+    if len(fields) != 3:
+        return None, None
+    username = fields[0].strip()
+    score = fields[2].strip()
+    if username == "" or not score.isascii() or not score.lstrip("-").isdigit():
+        return None, None
+    return sys.intern(username), UserRecord(fields[1].strip(), int(score))
+
+
+def load_users_file(path):
+    """
+    Streams the users file line by line - only one line is in memory besides the records
+    :param path: the users file
+    :type path: str
+    return: dictionary of usernames to their UserRecord
+    :rtype: dict
+    """
+    users = {}
+    with open(path, "r", encoding="utf-8") as users_file:
+        for line in users_file:
+            username, record = parse_user_line(line)
+            if username is not None:
+                users[username] = record
+    return users